@@ -1,6 +1,6 @@
-import re, protocols
-from typing import Tuple, Dict, List, Optional, Generator, cast
-from utils import units2bytes, Units, ts2filter
+import re, protocols, hashlib
+from typing import Tuple, Dict, List, Optional, Generator, Iterable, cast
+from utils import units2bytes, Units, ts2filter, ts2minute, minute2ts
 from datetime import datetime as dt, timedelta as td
 from storage import Entry
 
@@ -11,6 +11,8 @@ class Additionals(protocols.Additionals):
         self._entry = Entry()
         self._min_ts = dt.now()
         routerset = set()
+        with open(adds_path, 'rb') as fdb:
+            self._hash = hashlib.sha256(fdb.read()).hexdigest()
         with open(adds_path) as fd:
             for line in fd:
                 line = line.strip()
@@ -38,6 +40,13 @@ class Additionals(protocols.Additionals):
                     comment = (comment_str if len(comment_str) > 0 else None)
                     self._adds.append(protocols.AddsEntry(ts, 'data', router, host, int(amount), comment))
         self._routers: Tuple[str, ...] = tuple(routerset)
+        # key of every add in adds_applied and adds_usage, identical lines get the number of their occurrence
+        self._keys: List[str] = []
+        occurrences: Dict[protocols.AddsEntry, int] = {}
+        for add in self._adds:
+            occurrences[add] = occurrences.get(add, 0) + 1
+            key = (add.ts.strftime('%Y-%m-%d %H:%M'), add.atype, add.router, add.host, str(add.amount), add.comment)
+            self._keys.append(repr(key if occurrences[add] == 1 else key + (occurrences[add],)))
 
     @property
     def routers(self) -> Tuple[str, ...]:
@@ -51,53 +60,150 @@ class Additionals(protocols.Additionals):
             if router == adds.router:
                 yield adds
 
-    def _apply_adds(self, row: protocols.DataRow) -> Optional[bool]:
-        e = self._entry; e.row = row
-        curr_dat = e.dat_in + e.dat_out
-        for add in self._adds:
+    def _replay_start(self, store: protocols.Storage) -> Optional[int]:
+        """Earliest minute an add change or newly loaded data can affect, -1 for a full replay, None if nothing changed."""
+        if store.get_state('adds_hash') is None: return -1
+        starts = []
+        ingest_ts = store.get_state('ingest_ts')
+        if ingest_ts is not None:
+            starts.append(int(ingest_ts))
+        if store.get_state('adds_hash') != self._hash:
+            applied = store.adds_applied
+            current = {self._keys[index]: ts2minute(add.ts) for index, add in enumerate(self._adds)}
+            starts.extend(ts for key, ts in current.items() if key not in applied)
+            starts.extend(ts for key, ts in applied.items() if key not in current)
+        return min(starts) if len(starts) > 0 else None
+
+    def _compile_adds(self) -> None:
+        """Sort boosts per router and data adds per (router, host) by start minute for the sweep in _apply_adds."""
+        self._boosts: Dict[str, List[Tuple[int, int, int, protocols.AddsEntry]]] = {}
+        self._datas: Dict[Tuple[str, Optional[str]], List[Tuple[int, int, int, protocols.AddsEntry]]] = {}
+        for index, add in enumerate(self._adds):
             if add.atype == 'boost':
-                if self._collect_rows is not None and add not in self._collect_rows:
-                    self._collect_rows[add] = []
-                if curr_dat > 0 and add.router == e.router \
-                   and e.ts >= add.ts and e.ts <= self._end_ts[add]:
+                self._boosts.setdefault(add.router, []).append(
+                    (ts2minute(add.ts), index, ts2minute(self._end_ts[add]), add))
+            elif add.atype == 'data':
+                self._datas.setdefault((add.router, add.host), []).append((ts2minute(add.ts), index, 0, add))
+        for pending in list(self._boosts.values()) + list(self._datas.values()):
+            pending.sort()
+        # index of the next pending add and the started adds in file order, per router or (router, host)
+        self._boosts_active: Dict[str, Tuple[int, List[Tuple[int, int, int, protocols.AddsEntry]]]] = {}
+        self._datas_active: Dict[Tuple[str, Optional[str]], Tuple[int, List[Tuple[int, int, int, protocols.AddsEntry]]]] = {}
+        # whether _apply_adds has set up the row lists of collect_rows in the current apply_to_storage
+        self._collect_started: bool = False
+
+    def _boost_intervals(self, start: int) -> Generator[Tuple[str, int, int], None, None]:
+        """Boost intervals from minute start on, merged per router."""
+        for router, pending in self._boosts.items():
+            merged: List[List[int]] = []
+            for first, _, last, _ in pending:
+                if last < start: continue
+                first = max(first, start)
+                if len(merged) > 0 and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            for first, last in merged:
+                yield router, first, last
+
+    @staticmethod
+    def _sweep(pending: List[Tuple[int, int, int, protocols.AddsEntry]],
+               state: Tuple[int, List[Tuple[int, int, int, protocols.AddsEntry]]],
+               ts: int) -> Tuple[int, List[Tuple[int, int, int, protocols.AddsEntry]]]:
+        pos, active = state
+        if pos < len(pending) and pending[pos][0] <= ts:
+            while pos < len(pending) and pending[pos][0] <= ts:
+                active.append(pending[pos])
+                pos += 1
+            active.sort(key = lambda x: x[1])
+        return pos, active
+
+    def _apply_adds(self, row: protocols.DataRow) -> int:
+        # rows come in ascending ts, so an add once started stays started and a boost once ended stays ended
+        e = self._entry; e.row = row
+        if self._collect_rows is not None and not self._collect_started:
+            for add in self._adds:
+                self._collect_rows.setdefault(add, [])
+            self._collect_started = True
+        ts, router = e.ts_minute, e.router
+        if self._collect_rows is None:
+            # boosts were already applied by clear_dat
+            curr_dat = e.dat
+        else:
+            # rows are collected as streamed, so boosts take the per-row path here
+            curr_dat = e.dat_in + e.dat_out
+            if curr_dat > 0 and router in self._boosts:
+                pos, active = self._boosts_active[router] = self._sweep(
+                    self._boosts[router], self._boosts_active.get(router, (0, [])), ts)
+                if len(active) > 0 and active[0][2] < ts:
+                    active[:] = [x for x in active if x[2] >= ts]
+                if len(active) > 0:
                     curr_dat = 0
-                    if self._collect_rows is not None:
-                        self._collect_rows[add].append(row)
-        for add in self._adds:
-            if add.atype == 'data':
-                if self._collect_rows is not None and add not in self._collect_rows:
-                    self._collect_rows[add] = []
-                if curr_dat > 0 and add.router == e.router \
-                   and add.host == e.host and self._unused_data[add] > 0 and e.ts >= add.ts:
-                    amount = min(self._unused_data[add], curr_dat)
-                    self._unused_data[add] -= amount
-                    curr_dat -= amount
-                    if self._collect_rows is not None:
-                        self._collect_rows[add].append(row)
-        if curr_dat != e.dat:
-            self._entryids.append((e.id, curr_dat))
-        return True
+                    self._collect_rows[active[0][3]].append(row)
+        key = (router, e.host)
+        if curr_dat > 0 and key in self._datas:
+            pos, active = self._datas_active[key] = self._sweep(
+                self._datas[key], self._datas_active.get(key, (0, [])), ts)
+            for _, index, _, add in active:
+                if curr_dat == 0: break
+                if self._unused_data[index] <= 0: continue
+                amount = min(self._unused_data[index], curr_dat)
+                self._unused_data[index] -= amount
+                self._usage.append((self._keys[index], ts, amount))
+                curr_dat -= amount
+                if self._collect_rows is not None:
+                    self._collect_rows[add].append(row)
+            if len(active) > 0 and self._unused_data[active[0][1]] <= 0:
+                active[:] = [x for x in active if self._unused_data[x[1]] > 0]
+        return curr_dat
+
+    def _changes(self, rows: Iterable[protocols.DataRow]) -> Generator[Tuple[int, int], None, None]:
+        e = self._entry
+        for row in rows:
+            curr_dat = self._apply_adds(row)
+            if curr_dat != e.dat:
+                yield e.id, curr_dat
 
     def apply_to_storage(self, store: protocols.Storage,
                          collect_rows: Optional[Dict[protocols.AddsEntry, List[protocols.DataRow]]] = None) -> None:
-        store.reset_dat()
-        self._entryids: List[Tuple[int, int]] = []
+        start = -1 if collect_rows is not None else self._replay_start(store)
+        if start is None: return
+        if store.frozen_ts is not None and start < ts2minute(store.frozen_ts):
+            # frozen or downsampled rows keep the adds as they were applied before
+            start = ts2minute(store.frozen_ts)
+        start_ts = None if start < 0 else minute2ts(start)
+        store.reset_dat(start_ts)
+        used = {} if start_ts is None else store.adds_usage(start_ts)
+        self._usage: List[Tuple[str, int, int]] = []
         self._collect_rows = collect_rows
-        self._unused_data: Dict[protocols.AddsEntry, int] = {}
+        self._collect_started = False
+        # unused amount of every data add by its index
+        self._unused_data: Dict[int, int] = {}
         flt = set()
-        for add in self._adds:
+        for index, add in enumerate(self._adds):
             self._current_add = add
             if add.atype == 'boost':
                 self._end_ts[add] = add.ts + cast(td, add.amount)
-                flt.add("(router = '%s' AND %s AND %s)" % (add.router, ts2filter(add.ts, '>'), ts2filter(self._end_ts[add], '<')))
+                if collect_rows is not None:
+                    flt.add("(router = '%s' AND %s AND %s)" % (add.router, ts2filter(add.ts, '>'), ts2filter(self._end_ts[add], '<')))
             elif add.atype == 'data':
-                self._unused_data[add] = cast(int, add.amount)
+                self._unused_data[index] = cast(int, add.amount) - used.get(self._keys[index], 0)
                 flt.add("(router = '%s' AND host = '%s' AND %s)" % (add.router, add.host, ts2filter(add.ts, '>')))
-        store.apply_mask(self._min_ts, self._apply_adds, flt = " OR ".join(flt))
-        store.update_entries('dat', self._entryids)
+        self._compile_adds()
+        mask_ts = self._min_ts if start_ts is None else max(self._min_ts, start_ts)
+        if collect_rows is None:
+            for router, first, last in self._boost_intervals(ts2minute(mask_ts)):
+                store.clear_dat(router, minute2ts(first), minute2ts(last))
+        if len(flt) > 0:
+            store.update_entries('dat', self._changes(store.rows(mask_ts, flt = " OR ".join(flt))))
+        store.update_adds_usage(start_ts, self._usage)
         rest_adds: Dict[str, int] = {}
-        for add, amount in self._unused_data.items():
+        for index, amount in self._unused_data.items():
+            add = self._adds[index]
             if add.atype != 'data': continue
             if add.host is None: continue
             rest_adds[add.host] = rest_adds.get(add.host, 0) + amount
         store.rest_adds = rest_adds
+        store.adds_applied = {self._keys[index]: ts2minute(add.ts) for index, add in enumerate(self._adds)}
+        store.set_state('adds_hash', self._hash)
+        store.set_state('ingest_ts', None)
@@ -2,8 +2,6 @@
 
 import sys
 import IPython # type: ignore
-import protocols as p
-from typing import Dict
 from data_config import accounts, lnames
 from storage import Storage
 from reports import AccountsReport
@@ -17,9 +15,7 @@ router = sys.argv[3]
 directory = sys.argv[4]
 db_file = sys.argv[5]
 
-storage = Storage(db_file, accounts, directory, False)
+storage = Storage(db_file, accounts, directory, False, 'report')
 reports = AccountsReport(lnames, accounts, storage)
-host_usage: Dict[str, Dict[p.Host, p.Usage]] = {}
-for limit_name in lnames:
-    host_usage[limit_name] = reports.host_usage(start_ts, router, limit_name)
+_, host_usage = reports.usage(start_ts, router)
 IPython.embed()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3.8
+
+import os, sys, struct, zlib, time, hashlib
+from typing import Tuple, List, Optional, Dict, Callable
+
+InputRow = Tuple[int, int, int, int, int, Optional[str], str]
+
+# minute of day, dat_in, dat_out, dat_pkg, router id, dat_id, crc32 of the preceding fields
+RECORD = struct.Struct('<HQQIH11sI')
+ROUTERS_FILE = 'routers'
+NO_ROUTER = 0xffff
+SUFFIX = '.bin'
+
+def parse_data_file(fname: str, position: int = 0, lines: int = 0) -> Tuple[List[InputRow], int, int]:
+    """Parse the complete lines of a day file after byte position, returns rows and the new position and line count."""
+    result: List[InputRow] = []
+    id_int = int.from_bytes(hashlib.shake_256(fname.encode('utf-8')).digest(11), 'big') + lines
+    with open(fname, 'rb') as fd:
+        fd.seek(position)
+        chunk = fd.read()
+    consumed = chunk.rfind(b'\n') + 1
+    for raw_line in chunk[:consumed].split(b'\n')[:-1]:
+        id_int += 1
+        lines += 1
+        line = raw_line.decode('utf-8', 'replace').replace('\0', '').strip()
+        if len(line) == 0: continue
+        data_router: Optional[str] = None
+        try:
+            data = line.split(' ')
+            if len(data) == 8:
+                # checksummed line, the crc32 of the rest of the line comes first
+                crc, line = line.split(' ', 1)
+                if int(crc, 16) != zlib.crc32(line.encode('utf-8')):
+                    raise RuntimeError("checksum mismatch: %s" % repr(data))
+                data = data[1:]
+            if len(data) == 7:
+                hour, minute, data_in, data_out, data_pkg, data_router, dat_id = \
+                    int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4]), data[5], data[6]
+            elif len(data) == 6:
+                hour, minute, data_in, data_out, data_pkg, data_router = \
+                    int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4]), data[5]
+                dat_id = id_int.to_bytes(11, 'big').hex()
+            elif len(data) == 5:
+                hour, minute, data_in, data_out, data_pkg = \
+                    int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4])
+                dat_id = id_int.to_bytes(11, 'big').hex()
+            else: raise RuntimeError("wrong line format: %s" % repr(data))
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise RuntimeError("wrong time: %s" % repr(data))
+        except Exception as err:
+            sys.stderr.write("ERROR on parsing %s: %s\n" % (repr(fname), repr(err)))
+            continue
+        if data_router ==  'mikrotik' and (data_in + data_out) < data_pkg:
+            # temporary to fix bug (2020-02-10)
+            data_in, data_pkg = data_pkg, data_in
+        result.append((hour, minute, data_in, data_out, data_pkg, data_router, dat_id))
+    return result, position + consumed, lines
+
+def binary_name(fname: str) -> str:
+    return fname + SUFFIX
+
+def router_names(data_path: str) -> Tuple[str, ...]:
+    try:
+        with open(os.path.join(data_path, ROUTERS_FILE)) as fd:
+            return tuple(x.strip() for x in fd if len(x.strip()) > 0)
+    except FileNotFoundError: return tuple()
+
+def router_id(data_path: str, router: Optional[str]) -> int:
+    if router is None: return NO_ROUTER
+    routers = router_names(data_path)
+    if router not in routers:
+        fd = os.open(os.path.join(data_path, ROUTERS_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try: os.write(fd, ('%s\n' % router).encode('utf-8'))
+        finally: os.close(fd)
+        routers = router_names(data_path)
+    return routers.index(router)
+
+def pack_record(hour: int, minute: int, dat_in: int, dat_out: int, dat_pkg: int,
+                router: int, dat_id: bytes) -> bytes:
+    data = RECORD.pack(hour * 60 + minute, dat_in, dat_out, dat_pkg, router, dat_id, 0)
+    return data[:-4] + struct.pack('<I', zlib.crc32(data[:-4]))
+
+def format_line(hour: int, minute: int, dat_in: int, dat_out: int, dat_pkg: int,
+                router: str, dat_id: str) -> bytes:
+    line = '%d %d %d %d %d %s %s' % (hour, minute, dat_in, dat_out, dat_pkg, router, dat_id)
+    return ('%08x %s\n' % (zlib.crc32(line.encode('utf-8')), line)).encode('utf-8')
+
+def _append(fname: str, data: bytes, align: Callable[[int, int], bytes]) -> None:
+    # one write() on an O_APPEND descriptor, so a reader never sees two records interleaved;
+    # a record torn by a crash is first closed by the alignment prefix and then fails its checksum
+    fd = os.open(fname, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try: os.write(fd, align(fd, os.fstat(fd).st_size) + data)
+    finally: os.close(fd)
+
+def _line_align(fd: int, size: int) -> bytes:
+    return b'\n' if size > 0 and os.pread(fd, 1, size - 1) != b'\n' else b''
+
+def _record_align(fd: int, size: int) -> bytes:
+    return b'\0' * (-size % RECORD.size)
+
+def append_line(fname: str, line: bytes) -> None:
+    _append(fname, line, _line_align)
+
+def append_record(fname: str, record: bytes) -> None:
+    _append(fname, record, _record_align)
+
+def parse_binary_file(fname: str, routers: Tuple[str, ...],
+                      position: int = 0, records: int = 0) -> Tuple[List[InputRow], int, int]:
+    result: List[InputRow] = []
+    with open(fname, 'rb') as fd:
+        fd.seek(position)
+        chunk = fd.read()
+    consumed = len(chunk) - len(chunk) % RECORD.size
+    view = memoryview(chunk)[:consumed]
+    offset = 0
+    for day_minute, dat_in, dat_out, dat_pkg, router, dat_id, crc in RECORD.iter_unpack(view):
+        if zlib.crc32(view[offset:offset + RECORD.size - 4]) != crc:
+            sys.stderr.write("ERROR on parsing %s: checksum mismatch at %d\n" % (repr(fname), position + offset))
+        elif router != NO_ROUTER and router >= len(routers):
+            sys.stderr.write("ERROR on parsing %s: unknown router id %d\n" % (repr(fname), router))
+        else:
+            hour, minute = divmod(day_minute, 60)
+            result.append((hour, minute, dat_in, dat_out, dat_pkg,
+                           None if router == NO_ROUTER else routers[router], dat_id.hex()))
+        offset += RECORD.size
+    return result, position + consumed, records + consumed // RECORD.size
+
+def convert_file(fname: str, data_path: str) -> int:
+    """Convert a text day file into a binary one and remove it, returns the number of records. A file with bytes
+    after its last complete line, being written or torn, is left as it is and 0 returned."""
+    rows, position, _ = parse_data_file(fname)
+    if position != os.path.getsize(fname): return 0
+    router_ids: Dict[Optional[str], int] = {}
+    records = []
+    for hour, minute, dat_in, dat_out, dat_pkg, router, dat_id in rows:
+        if router not in router_ids:
+            router_ids[router] = router_id(data_path, router)
+        records.append(pack_record(hour, minute, dat_in, dat_out, dat_pkg,
+                                   router_ids[router], bytes.fromhex(dat_id)))
+    bin_fname = binary_name(fname)
+    with open(bin_fname + '.tmp', 'wb') as fd:
+        for record in records:
+            fd.write(record)
+        try:
+            with open(bin_fname, 'rb') as fdo:
+                fd.write(fdo.read())
+        except FileNotFoundError: pass
+    os.rename(bin_fname + '.tmp', bin_fname)
+    os.unlink(fname)
+    return len(records)
+
+def convert_directory(data_path: str, convert_today: bool = False) -> int:
+    today = time.strftime('day_%Y%m%d')
+    converted = 0
+    for hostname in sorted(os.listdir(data_path)):
+        host_path = os.path.join(data_path, hostname)
+        if not os.path.isdir(host_path): continue
+        for fname in sorted(os.listdir(host_path)):
+            if not fname.startswith('day_') or fname.endswith(SUFFIX) or fname.endswith('.tmp'): continue
+            if fname == today and not convert_today: continue
+            converted += convert_file(os.path.join(host_path, fname), data_path)
+    return converted
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != 'all'):
+        sys.stderr.write('Usage: %s <directory> [all]\n' % sys.argv[0])
+        sys.exit(1)
+    print('%d records converted' % convert_directory(sys.argv[1], len(sys.argv) == 3))
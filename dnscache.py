@@ -0,0 +1,138 @@
+import os, fcntl, socket, time, queue, threading, ipaddress, dayfile
+from typing import Dict, Tuple, Optional, Iterable, Callable, List
+
+CACHE_FILE = 'dns.cache'
+DOMAIN = '.kozachuk.info'
+
+def _ptr(ip: str) -> str:
+    return socket.gethostbyaddr(ip)[0]
+
+def _is_ip(text: str) -> bool:
+    try: ipaddress.ip_address(text)
+    except ValueError: return False
+    return True
+
+class NameCache(object):
+    """Reverse DNS names of the collectors, kept on disk between the runs in data_path/dns.cache with a ttl
+    for names and a shorter one for failed lookups. Lookups run in parallel daemon threads until a deadline,
+    an address without a name in time stays the name of itself for this run."""
+    def __init__(self, data_path: str,
+                 ttl: float = 86400,
+                 negative_ttl: float = 3600,
+                 workers: int = 16,
+                 lookup: Callable[[str], str] = _ptr) -> None:
+        self._path = os.path.join(data_path, CACHE_FILE)
+        self._ttl, self._negative_ttl = ttl, negative_ttl
+        self._workers = workers
+        self._lookup = lookup
+        # address: (name or None after a failed lookup, expiry in time.time())
+        self._entries: Dict[str, Tuple[Optional[str], float]] = self._read()
+
+    def _read(self) -> Dict[str, Tuple[Optional[str], float]]:
+        entries: Dict[str, Tuple[Optional[str], float]] = {}
+        try:
+            with open(self._path) as fd:
+                for line in fd:
+                    try: ip, name, expiry = line.split()
+                    except ValueError: continue
+                    entries[ip] = (None if name == '-' else name, float(expiry))
+        except FileNotFoundError: pass
+        return entries
+
+    def save(self) -> None:
+        """Write the entries merged with the ones another collector saved meanwhile, the later expiry wins."""
+        entries = self._read()
+        for ip, entry in self._entries.items():
+            if ip not in entries or entries[ip][1] < entry[1]:
+                entries[ip] = entry
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            for ip in sorted(entries):
+                name, expiry = entries[ip]
+                fd.write('%s %s %d\n' % (ip, '-' if name is None else name, expiry))
+        os.rename(tmp_path, self._path)
+
+    def names(self, ips: Iterable[str], deadline: float = 2) -> Dict[str, str]:
+        """Name of every address, looked up again when expired. An expired name is kept when its lookup
+        does not finish by the deadline, an address without any name is its own name."""
+        ips = set(ips)
+        now = time.time()
+        todo = [ip for ip in ips if ip not in self._entries or self._entries[ip][1] < now]
+        if len(todo) > 0:
+            jobs: queue.Queue[str] = queue.Queue()
+            for ip in todo: jobs.put(ip)
+            results: Dict[str, Optional[str]] = {}
+            done = threading.Condition()
+            def worker() -> None:
+                while True:
+                    try: ip = jobs.get_nowait()
+                    except queue.Empty: return
+                    try: name: Optional[str] = self._lookup(ip)
+                    except OSError: name = None
+                    with done:
+                        results[ip] = name
+                        done.notify_all()
+            # daemon threads, a lookup still hanging at the deadline does not keep the collector alive
+            for _ in range(min(self._workers, len(todo))):
+                threading.Thread(target = worker, daemon = True).start()
+            with done:
+                done.wait_for(lambda: len(results) == len(todo), deadline)
+                for ip, name in results.items():
+                    self._entries[ip] = (name, now + (self._ttl if name is not None else self._negative_ttl))
+        return {ip: self._entries.get(ip, (None, 0.0))[0] or ip for ip in ips}
+
+def _append_moved(tmp_path: str, dst: str) -> None:
+    """Append a day file renamed to tmp_path to dst, then empty and remove it. The lock keeps two runs from both
+    appending it, one finding it empty leaves it."""
+    try: fd = open(tmp_path, 'r+b')
+    except FileNotFoundError: return
+    with fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = fd.read()
+        # in one append, a torn line or record at the end goes along and is closed by the next append as before
+        if dst.endswith(dayfile.SUFFIX):
+            complete = len(data) - len(data) % dayfile.RECORD.size
+            records = (data[pos:pos + dayfile.RECORD.size] for pos in range(0, complete, dayfile.RECORD.size))
+            data = b''.join(x for x in records if x.strip(b'\0')) + data[complete:]
+            if len(data) > 0: dayfile.append_record(dst, data)
+        elif len(data) > 0: dayfile.append_line(dst, data)
+        # emptied right after the append, a crash before the unlink leaves nothing to append again
+        fd.truncate(0)
+        try: os.unlink(tmp_path)
+        except FileNotFoundError: pass
+
+def reconcile(data_path: str, cache: NameCache, deadline: float = 2) -> List[Tuple[str, str]]:
+    """Move the day files written under an address, as it had no name then, into the directory of its host
+    name once the name is known. Returns the moved addresses and host names."""
+    moved = []
+    ips = [x for x in sorted(os.listdir(data_path)) if _is_ip(x) and os.path.isdir(os.path.join(data_path, x))]
+    names = cache.names(ips, deadline) if len(ips) > 0 else {}
+    for ip in ips:
+        ip_path = os.path.join(data_path, ip)
+        name = names[ip]
+        if not name.endswith(DOMAIN): continue
+        hostname = name[:-len(DOMAIN)]
+        host_path = os.path.join(data_path, hostname)
+        os.makedirs(host_path, exist_ok = True)
+        # the other collector may reconcile at the same time, a file it moved first is gone here
+        try: fnames = sorted(os.listdir(ip_path))
+        except FileNotFoundError: continue
+        # day_<date>[.bin][.<pid>].tmp files left by a run that crashed go first
+        for fname in fnames:
+            if not fname.startswith('day_') or not fname.endswith('.tmp'): continue
+            name = fname[:-len('.tmp')]
+            base, _, pid = name.rpartition('.')
+            _append_moved(os.path.join(ip_path, fname), os.path.join(host_path, base if pid.isdigit() else name))
+        for fname in fnames:
+            if not fname.startswith('day_') or fname.endswith('.tmp'): continue
+            # renamed first, so an append by a collector meanwhile goes into a new file of the next run;
+            # the pid keeps the name apart from the files other runs are moving
+            src = os.path.join(ip_path, fname)
+            tmp_path = '%s.%d.tmp' % (src, os.getpid())
+            try: os.rename(src, tmp_path)
+            except FileNotFoundError: continue
+            _append_moved(tmp_path, os.path.join(host_path, fname))
+        try: os.rmdir(ip_path)
+        except OSError: pass
+        moved.append((ip, hostname))
+    return moved
@@ -1,16 +1,79 @@
-import os
+import os, re
 import protocols as p
 from marks import Mark
-from typing import Dict, Tuple, Optional, Callable, Any
+from resolver import Resolver
+from typing import Dict, Tuple, Optional, Callable, Any, List, Generator, Iterable, Set
+
+# rules of restore() carry a comment usage:<host>:<address>:<src|dst>:<mark<n>|reject>, the rules of a table are
+# told by it, so a rule of a host whose address changed is told from the wanted one
+COMMENT = re.compile(r'--comment "?(usage:[^" ]+)"?')
+# rules of filter() carry no comment, restore() deletes those of the addresses of the account hosts
+LEGACY = re.compile(r'^-A FORWARD -[sd] ([0-9.]+)(?:/32)? -j (?:MARK|REJECT)\b')
+BACKENDS = {'iptables': '/sbin/iptables-restore', 'nftables': '/usr/sbin/nft'}
+# the last applied state per host, the rules are gone when the boot id changed
+STATE_FILE = 'firewall.state'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+# mark value, hard limit and address of a limited host
+HostState = Tuple[int, bool, str]
+
+def _boot_id() -> str:
+    try:
+        with open(BOOT_ID) as fd: return fd.read().strip()
+    except OSError: return ''
+
+def load_state(directory: str, backend: str) -> Optional[Dict[str, HostState]]:
+    """Host states last applied by backend since this boot, None if unknown."""
+    state: Dict[str, HostState] = {}
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as fd:
+            if fd.readline().split() != ['boot', _boot_id() or '-', backend]: return None
+            for line in fd:
+                name, mark, reject, address = line.split()
+                state[name] = (int(mark), reject == 'reject', address)
+    except (OSError, ValueError): return None
+    return state
+
+def save_state(directory: str, backend: str, state: Dict[str, HostState]) -> None:
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as fd:
+        fd.write('boot %s %s\n' % (_boot_id() or '-', backend))
+        for name in sorted(state):
+            fd.write('%s %d %s %s\n' % (name, state[name][0], 'reject' if state[name][1] else 'mark', state[name][2]))
+    os.rename(path + '.tmp', path)
+
+def _describe(state: Optional[HostState]) -> str:
+    if state is None: return 'none'
+    return '%s mark %d%s' % (state[2], state[0], ', reject' if state[1] else '')
 
 class Filtering(object):
     def __init__(self,
                  limit_names: Tuple[str, ...],
                  accounts: Tuple[p.Account, ...],
-                 account_usage: Dict[str, Dict[p.Account, p.Usage]]) -> None:
+                 account_usage: Dict[str, Dict[p.Account, p.Usage]],
+                 resolver: Optional[Resolver] = None) -> None:
         self._limit_names = limit_names
         self._accounts = accounts
         self._account_usage = account_usage
+        self._resolver = resolver
+        self._resolved: Optional[Dict[str, str]] = None
+        self._unresolved: Set[str] = set()
+
+    def _address(self, name: str) -> Optional[str]:
+        """Address of the host for the rules of restore(), nftables() and apply(), None if unresolved."""
+        if self._resolved is None:
+            self._resolved = {} if self._resolver is None else \
+                self._resolver.addresses(host.name for account in self._accounts for host in account.hosts)
+        return self._resolved.get(name)
+
+    def _wanted(self, rest_adds: Optional[Dict[str, int]], known: Dict[str, str]) -> Dict[str, HostState]:
+        """States of the limited hosts. An unresolved host keeps its address known to be applied, without one
+        it is left out, as the firewall would look its name up itself and fail the whole transaction on it."""
+        wanted: Dict[str, HostState] = {}
+        for name, mark, hardlimit in self._limited(rest_adds):
+            address = self._address(name) or known.get(name)
+            if address is None: self._unresolved.add(name)
+            else: wanted[name] = (mark, hardlimit, address)
+        return wanted
 
     def filter(self, directory: str,
                rest_adds: Optional[Dict[str, int]] = None,
@@ -67,3 +130,174 @@ class Filtering(object):
                     cmd('''%s | grep -q "REJECT.*anywhere.*%s.kozachuk.info" && { set -x; /sbin/iptables -t filter -D FORWARD -d %s.kozachuk.info/32 -j REJECT; }''' \
                               % (ipfcache, host.name, host.name))
         cmd('/sbin/iptables -t mangle -L FORWARD -x -v 2>&1 | grep -q "CONNMARK save" || /sbin/iptables -t mangle -A FORWARD -j CONNMARK --save-mark')
+
+    def _limited(self, rest_adds: Optional[Dict[str, int]] = None) -> Generator[Tuple[str, int, bool], None, None]:
+        """Host name, mark value and hard limit of the hosts of every account over its first exceeded limit, hard limited
+        from 120% on, both not for hosts with additional contingent left."""
+        for account in self._accounts:
+            if account.ignore: continue
+            for limit in sorted(self._limit_names):
+                if limit not in self._account_usage \
+                   or account not in self._account_usage[limit]:
+                    continue
+                usage = self._account_usage[limit][account]
+                percent = int(usage.dat / account.limit(limit).amount * 100)
+                if percent < 100: continue
+                for host in account.hosts:
+                    if rest_adds is not None and rest_adds.get(host.name, 0) > 0: continue
+                    yield host.name, account.mark.value, percent >= 120 and not account.no_hardlimit
+                break
+
+    def _rules(self, limited: Iterable[Tuple[str, int, bool, str]]) -> Dict[str, Dict[str, str]]:
+        """Rules of the limited hosts, given with their address, per table by their comment."""
+        rules: Dict[str, Dict[str, str]] = {'mangle': {}, 'filter': {}}
+        for name, mark, hardlimit, address in limited:
+            for direction, option in (('src', '-s'), ('dst', '-d')):
+                comment = 'usage:%s:%s:%s:mark%d' % (name, address, direction, mark)
+                rules['mangle'][comment] = '%s %s -m comment --comment %s -j MARK --set-mark %d' \
+                    % (option, address, comment, mark)
+                if hardlimit:
+                    comment = 'usage:%s:%s:%s:reject' % (name, address, direction)
+                    rules['filter'][comment] = '%s %s -m comment --comment %s -j REJECT' \
+                        % (option, address, comment)
+        return rules
+
+    def restore(self, directory: str,
+                rest_adds: Optional[Dict[str, int]] = None,
+                cmd: Callable[[str], Any] = os.system) -> Any:
+        """Like filter(), but parses the FORWARD chains once and applies the difference to the wanted rules
+        in one iptables-restore --noflush transaction, written to directory/iptables.restore. The rules filter()
+        left for the account hosts are deleted with it. Returns the status of the failed or last command,
+        0 if there was nothing to do."""
+        if cmd is os.system and not os.path.exists(BACKENDS['iptables']): return 0
+        status = cmd('''/sbin/iptables-save -t mangle >%s/iptables.save && /sbin/iptables-save -t filter >>%s/iptables.save''' \
+                     % (directory, directory))
+        if status != 0: return status
+        existing: Dict[str, Dict[str, List[str]]] = {'mangle': {}, 'filter': {}}
+        legacy: Dict[str, List[Tuple[str, str]]] = {'mangle': [], 'filter': []}
+        known: Dict[str, str] = {}
+        connmark = False
+        table = ''
+        with open(os.path.join(directory, 'iptables.save')) as fd:
+            for line in fd:
+                line = line.strip()
+                if line.startswith('*'): table = line[1:]
+                if table not in existing or not line.startswith('-A FORWARD '): continue
+                if table == 'mangle' and 'CONNMARK' in line and '--save-mark' in line: connmark = True
+                ma = COMMENT.search(line)
+                if ma is not None:
+                    existing[table].setdefault(ma.group(1), []).append(line[len('-A '):])
+                    fields = ma.group(1).split(':')
+                    if len(fields) == 5: known[fields[1]] = fields[2]
+                    continue
+                ma = LEGACY.search(line)
+                if ma is not None: legacy[table].append((ma.group(1), line[len('-A '):]))
+        wanted = self._rules((name,) + state for name, state in self._wanted(rest_adds, known).items())
+        addresses = {self._address(host.name) or known.get(host.name) for account in self._accounts for host in account.hosts}
+        lines: List[str] = []
+        for table in ('mangle', 'filter'):
+            changes = ['-D %s' % rule for address, rule in legacy[table] if address in addresses]
+            changes.extend('-D %s' % rule for comment in sorted(existing[table]) if comment not in wanted[table]
+                           for rule in existing[table][comment])
+            changes.extend('-I FORWARD %s' % wanted[table][comment] for comment in sorted(wanted[table])
+                           if comment not in existing[table])
+            if table == 'mangle' and not connmark:
+                changes.append('-A FORWARD -j CONNMARK --save-mark')
+            if len(changes) > 0:
+                lines.extend(['*%s' % table] + changes + ['COMMIT'])
+        if len(lines) == 0: return 0
+        with open(os.path.join(directory, 'iptables.restore'), 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        return cmd('''/sbin/iptables-restore --noflush <%s/iptables.restore''' % directory)
+
+    def nftables(self, directory: str,
+                 rest_adds: Optional[Dict[str, int]] = None,
+                 cmd: Callable[[str], Any] = os.system) -> Any:
+        """Keep the marks in the map marks and the hard limited hosts in the set rejects of the table ip usage,
+        so a packet costs two map and two set lookups however many hosts are limited. The table is created
+        if missing and the elements replaced in one nft -f transaction, written to directory/nftables.rules.
+        Returns the status of nft."""
+        if cmd is os.system and not os.path.exists(BACKENDS['nftables']): return 0
+        marks, rejects = [], []
+        for name, (mark, hardlimit, address) in self._wanted(rest_adds, {}).items():
+            marks.append('%s : %d' % (address, mark))
+            if hardlimit: rejects.append(address)
+        lines = ['add table ip usage',
+                 'add map ip usage marks { type ipv4_addr : mark ; }',
+                 'add set ip usage rejects { type ipv4_addr ; }',
+                 'add chain ip usage forward { type filter hook forward priority mangle ; policy accept ; }',
+                 'flush chain ip usage forward',
+                 'flush map ip usage marks',
+                 'flush set ip usage rejects']
+        if len(marks) > 0: lines.append('add element ip usage marks { %s }' % ', '.join(sorted(marks)))
+        if len(rejects) > 0: lines.append('add element ip usage rejects { %s }' % ', '.join(sorted(rejects)))
+        lines.extend(['add rule ip usage forward ip saddr @rejects reject',
+                      'add rule ip usage forward ip daddr @rejects reject',
+                      'add rule ip usage forward meta mark set ip saddr map @marks',
+                      'add rule ip usage forward meta mark set ip daddr map @marks',
+                      'add rule ip usage forward ct mark set meta mark'])
+        with open(os.path.join(directory, 'nftables.rules'), 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        return cmd('''/usr/sbin/nft -f %s/nftables.rules''' % directory)
+
+    def _update_iptables(self, directory: str, last: Dict[str, HostState], wanted: Dict[str, HostState],
+                         changed: List[str], cmd: Callable[[str], Any]) -> Any:
+        old = self._rules((name,) + last[name] for name in changed if name in last)
+        new = self._rules((name,) + wanted[name] for name in changed if name in wanted)
+        lines: List[str] = []
+        for table in ('mangle', 'filter'):
+            changes = ['-D FORWARD %s' % old[table][comment] for comment in sorted(old[table])
+                       if comment not in new[table]]
+            changes.extend('-I FORWARD %s' % new[table][comment] for comment in sorted(new[table])
+                           if comment not in old[table])
+            if len(changes) > 0:
+                lines.extend(['*%s' % table] + changes + ['COMMIT'])
+        with open(os.path.join(directory, 'iptables.restore'), 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        return cmd('''/sbin/iptables-restore --noflush <%s/iptables.restore''' % directory)
+
+    def _update_nftables(self, directory: str, last: Dict[str, HostState], wanted: Dict[str, HostState],
+                         changed: List[str], cmd: Callable[[str], Any]) -> Any:
+        lines: List[str] = []
+        for name in changed:
+            if name in last:
+                lines.append('delete element ip usage marks { %s }' % last[name][2])
+                if last[name][1]: lines.append('delete element ip usage rejects { %s }' % last[name][2])
+            if name in wanted:
+                lines.append('add element ip usage marks { %s : %d }' % (wanted[name][2], wanted[name][0]))
+                if wanted[name][1]: lines.append('add element ip usage rejects { %s }' % wanted[name][2])
+        with open(os.path.join(directory, 'nftables.rules'), 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        return cmd('''/usr/sbin/nft -f %s/nftables.rules''' % directory)
+
+    def apply(self, directory: str,
+              rest_adds: Optional[Dict[str, int]] = None,
+              backend: str = 'iptables',
+              cmd: Callable[[str], Any] = os.system,
+              dry_run: bool = False) -> List[str]:
+        """Bring the firewall from the state last applied, kept in directory/firewall.state, to the wanted one
+        touching only the hosts whose mark, hard limit or address changed. Without a state of this boot and backend, or when the
+        update fails, everything is applied by restore() or nftables(); when that fails too, the state is
+        dropped so the next run applies everything again. Returns the host transitions, the hosts left out
+        for want of an address and such a failure."""
+        if backend not in BACKENDS:
+            raise ValueError('Firewall backend %s unknown, need to be one of: %s.' % (repr(backend), ', '.join(BACKENDS)))
+        last = load_state(directory, backend)
+        wanted = self._wanted(rest_adds, {name: state[2] for name, state in (last or {}).items()})
+        changed = sorted(name for name in set(wanted) | set(last or {})
+                         if last is None or last.get(name) != wanted.get(name))
+        report = ['%s: %s -> %s' % (name, '?' if last is None else _describe(last.get(name)),
+                                    _describe(wanted.get(name))) for name in changed] + \
+                 ['%s: no address, left out' % name for name in sorted(self._unresolved)]
+        if dry_run or (cmd is os.system and not os.path.exists(BACKENDS[backend])): return report
+        update = self._update_nftables if backend == 'nftables' else self._update_iptables
+        status: Any = 0
+        if last is None or (len(changed) > 0 and update(directory, last, wanted, changed, cmd) != 0):
+            if backend == 'nftables': status = self.nftables(directory, rest_adds, cmd)
+            else: status = self.restore(directory, rest_adds, cmd)
+        if status != 0:
+            try: os.unlink(os.path.join(directory, STATE_FILE))
+            except FileNotFoundError: pass
+            return report + ['%s: failed with status %s, the state is dropped' % (backend, status)]
+        save_state(directory, backend, wanted)
+        return report
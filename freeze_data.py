@@ -0,0 +1,32 @@
+#!/usr/bin/env python3.8
+
+import sys, time, os
+from storage import Storage
+from datetime import datetime as dt
+from data_config import accounts
+
+timing = time.monotonic()
+def t() -> str: return "%ds" % int(time.monotonic() - timing)
+
+if len(sys.argv) not in (4, 5) or (len(sys.argv) == 5 and sys.argv[4] != 'hourly'):
+    sys.stderr.write('Usage: %s <keep_months> <directory> <dbfile> [hourly]\n' % sys.argv[0])
+    sys.exit(1)
+
+keep_months = int(sys.argv[1])
+directory = sys.argv[2]
+db_file = sys.argv[3]
+hourly = len(sys.argv) == 5
+pid = os.getpid()
+
+now = dt.now()
+month = now.year * 12 + now.month - 1 - keep_months
+before_ts = dt(month // 12, month % 12 + 1, 1)
+
+print(pid, t(), 'load data from file %s' % repr(db_file), flush = True)
+storage = Storage(db_file, accounts, directory, True, 'ingest')
+
+print(pid, t(), 'freeze months before %s' % before_ts.strftime('%Y-%m'), flush = True)
+for year, month, moved in storage.freeze_before(before_ts, hourly):
+    print(pid, t(), 'month %04d-%02d frozen, %d rows moved' % (year, month, moved), flush = True)
+
+print(pid, t(), 'finish freeze data process', flush = True)
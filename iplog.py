@@ -1,16 +1,18 @@
 #!/usr/bin/env python3.8
 
-import sys, os, socket, time, random
+import sys, os, time, random, dayfile
+from dnscache import NameCache, reconcile
 from typing import Dict
 
 directory = sys.argv[4]
-dns_cache = {}
+dns_cache = NameCache(directory)
 host_data: Dict[str, Dict[str, int]] = {}
 last_data = {}
 curtime = time.localtime()
 data_file = sys.argv[2]
 lastusage = sys.argv[1]
 router = sys.argv[3]
+binary = len(sys.argv) > 5 and sys.argv[5] == 'binary'
 
 def gen_id() -> int:
     return int(time.time()*100000000000000) * 1000 + random.randint(0, 999)
@@ -24,21 +26,24 @@ with open(lastusage) as fd:
         last_data[hostname] = {'in': host_in, 'out': host_out, 'pkg': host_pkg, 'id': gen_id()}
 
 with open(data_file) as fd:
-    for line in fd:
-        try:
-            the_ip, dat_out_str, dat_in_str, dat_pkg_str = line.strip().split(' ')
-            if the_ip not in dns_cache:
-                try: the_name = socket.gethostbyaddr(the_ip)[0]
-                except: the_name = the_ip
-                dns_cache[the_ip] = the_name
-            else: the_name = dns_cache[the_ip]
-            dat_out, dat_in, dat_pkg = int(dat_out_str), int(dat_in_str), int(dat_pkg_str)
-        except: continue
-        host = host_data.setdefault(the_name.replace('.kozachuk.info', ''), {})
-        host['out'] = host.get('out', 0) + dat_out
-        host['in']  = host.get('in', 0)  + dat_in
-        host['pkg'] = host.get('pkg', 0) + dat_pkg
-        host['id'] = gen_id()
+    rows = [line.strip().split(' ') for line in fd]
+# all addresses are resolved at once, those without a name in time are recorded under the address
+names = dns_cache.names(fields[0] for fields in rows if len(fields) == 4)
+for fields in rows:
+    try:
+        the_ip, dat_out_str, dat_in_str, dat_pkg_str = fields
+        the_name = names[the_ip]
+        dat_out, dat_in, dat_pkg = int(dat_out_str), int(dat_in_str), int(dat_pkg_str)
+    except: continue
+    hostname = the_name.replace('.kozachuk.info', '')
+    # counted under the address while it had no name, the last counters go with it to the name
+    if hostname != the_ip and the_ip in last_data and hostname not in last_data:
+        last_data[hostname] = last_data.pop(the_ip)
+    host = host_data.setdefault(hostname, {})
+    host['out'] = host.get('out', 0) + dat_out
+    host['in']  = host.get('in', 0)  + dat_in
+    host['pkg'] = host.get('pkg', 0) + dat_pkg
+    host['id'] = gen_id()
 
 with open(lastusage + '.tmp', 'w') as fd:
     new_data: Dict[str, Dict[str, int]] = {}
@@ -63,13 +68,13 @@ for hostname, host in new_data.items():
         continue
     fname = "%s%s/day_%02d%02d%02d" \
         % (directory, hostname, curtime.tm_year, curtime.tm_mon, curtime.tm_mday)
-    with open(fname + '.tmp', 'a') as fd:
-        try:
-            with open(fname) as fdo:
-                fd.write(fdo.read())
-        except FileNotFoundError: pass
-        fd.write('%d %d %d %d %d %s %s\n' \
-                 % (curtime.tm_hour, curtime.tm_min,
-                    host['in'], host['out'], host['pkg'],
-                    router, id_str(host['id'])))
-    os.rename(fname + '.tmp', fname)
+    if binary:
+        dayfile.append_record(dayfile.binary_name(fname),
+                              dayfile.pack_record(curtime.tm_hour, curtime.tm_min, host['in'], host['out'], host['pkg'],
+                                                  dayfile.router_id(directory, router), host['id'].to_bytes(11, 'big')))
+        continue
+    dayfile.append_line(fname, dayfile.format_line(curtime.tm_hour, curtime.tm_min, host['in'], host['out'], host['pkg'],
+                                                   router, id_str(host['id'])))
+
+reconcile(directory, dns_cache)
+dns_cache.save()
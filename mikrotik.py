@@ -1,39 +1,35 @@
 #!/usr/bin/env python3.8
 
-import sys, time, os, urllib.request, socket, random
+import sys, time, os, urllib.request, random, dayfile
+from dnscache import NameCache, reconcile
 
 URL = "http://%s/accounting/ip.cgi" % sys.argv[1]
 directory = sys.argv[2]
+binary = len(sys.argv) > 3 and sys.argv[3] == 'binary'
 curtime = time.localtime()
 data = {}
-dns_cache = {}
+dns_cache = NameCache(directory)
 
 def gen_id() -> int:
     return int(time.time()*10000000000000) * 1000 + random.randint(0, 999)
 def id_str(id: int) -> str:
     return id.to_bytes(11, 'big').hex()
 
-for row in urllib.request.urlopen(URL):
-    src_ip, dst_ip, dat_bytes, dat_pkgs, _, _ = row.decode('utf-8').strip().split(' ')
+def local(ip: str) -> bool:
+    return ip.startswith('10.10.1.') or ip.startswith('2a01:4f8:191:41a6:')
+
+rows = [row.decode('utf-8').strip().split(' ') for row in urllib.request.urlopen(URL)]
+# the local addresses are resolved at once, those without a name in time are recorded under the address
+names = dns_cache.names(ip for row in rows for ip in row[:2] if local(ip))
+for src_ip, dst_ip, dat_bytes, dat_pkgs, _, _ in rows:
     dat_pkgs, dat_bytes = int(dat_pkgs), int(dat_bytes)
-    if src_ip not in dns_cache:
-        src_name = src_ip
-        if src_ip.startswith('10.10.1.') or src_ip.startswith('2a01:4f8:191:41a6:'):
-            try: src_name = socket.gethostbyaddr(src_ip)[0]
-            except: pass
-        dns_cache[src_ip] = src_name
-    else: src_name = dns_cache[src_ip]
-    if dst_ip not in dns_cache:
-        dst_name = dst_ip
-        if dst_ip.startswith('10.10.1.') or dst_ip.startswith('2a01:4f8:191:41a6:'):
-            try: dst_name = socket.gethostbyaddr(dst_ip)[0]
-            except: pass
-        dns_cache[dst_ip] = dst_name
-    else: dst_name = dns_cache[dst_ip]
-    if src_name.endswith('.kozachuk.info') and src_ip not in ('10.10.1.8', '2a01:4f8:191:41a6:10:1:0:8'):
+    src_name, dst_name = names.get(src_ip, src_ip), names.get(dst_ip, dst_ip)
+    if local(src_ip) and (src_name.endswith('.kozachuk.info') or src_name == src_ip) \
+       and src_ip not in ('10.10.1.8', '2a01:4f8:191:41a6:10:1:0:8'):
         the_name = src_name.replace('.kozachuk.info', '')
         out = True
-    elif dst_name.endswith('.kozachuk.info') and dst_ip not in ('10.10.1.8', '2a01:4f8:191:41a6:10:1:0:8'):
+    elif local(dst_ip) and (dst_name.endswith('.kozachuk.info') or dst_name == dst_ip) \
+       and dst_ip not in ('10.10.1.8', '2a01:4f8:191:41a6:10:1:0:8'):
         the_name = dst_name.replace('.kozachuk.info', '')
         out = False
     else: continue
@@ -49,12 +45,13 @@ for hostname, host in data.items():
     if host['in'] == 0 and host['out'] == 0 and host['pkg'] == 0:
         continue
     fname = "%s%s/day_%02d%02d%02d" % (directory, hostname, curtime.tm_year, curtime.tm_mon, curtime.tm_mday)
-    write_data = '%d %d %d %d %d mikrotik %s\n' \
-        % (curtime.tm_hour, curtime.tm_min, host['in'], host['out'], host['pkg'], id_str(host['id']))
-    with open(fname + '.tmp', 'a') as fd:
-        try:
-            with open(fname) as fdo:
-                fd.write(fdo.read())
-        except FileNotFoundError: pass
-        fd.write(write_data)
-    os.rename(fname + '.tmp', fname)
+    if binary:
+        dayfile.append_record(dayfile.binary_name(fname),
+                              dayfile.pack_record(curtime.tm_hour, curtime.tm_min, host['in'], host['out'], host['pkg'],
+                                                  dayfile.router_id(directory, 'mikrotik'), host['id'].to_bytes(11, 'big')))
+        continue
+    dayfile.append_line(fname, dayfile.format_line(curtime.tm_hour, curtime.tm_min, host['in'], host['out'], host['pkg'],
+                                                   'mikrotik', id_str(host['id'])))
+
+reconcile(directory, dns_cache)
+dns_cache.save()
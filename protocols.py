@@ -1,6 +1,6 @@
 from marks import Mark
 from datetime import datetime, timedelta
-from typing import Protocol, Union, Tuple, NamedTuple, Optional, Any, Generator, Dict, Callable, Iterable, List
+from typing import Protocol, Union, Tuple, NamedTuple, Optional, Any, Generator, Dict, Callable, Iterable, List, Sequence
 
 class Host(Protocol):
     def __init__(self, name: str, ips: Union[Tuple[str, ...], None] = None) -> None: ...
@@ -25,7 +25,7 @@ class Usage(NamedTuple):
         return Usage(self.ref, self.inp - other.inp, self.out - other.out,
                      self.pkg - other.pkg, self.dat - other.dat)
     
-DataRow = Tuple[int, str, int, int, int, int, int, int, int, int, int, str]
+DataRow = Tuple[int, str, int, int, int, int, int, str]
 
 class Entry(Protocol):
     def __init__(self) -> None: ...
@@ -38,6 +38,8 @@ class Entry(Protocol):
     @property
     def host(self) -> str: ...
     @property
+    def ts_minute(self) -> int: ...
+    @property
     def year(self) -> int: ...
     @property
     def month(self) -> int: ...
@@ -63,20 +65,49 @@ class Entry(Protocol):
 class Storage(Protocol):
     _conn: Any
     def __init__(self, accounts: Tuple["Account", ...], data_path: str, create_db: bool) -> None: ...
-    def load_data(self, start_ts: datetime, days: int) -> None: ...
-    def reset_dat(self) -> None: ...
+    def load_data(self, start_ts: datetime, days: int, workers: int = 0,
+                  changed: Optional[Iterable[str]] = None) -> None: ...
+    def reset_dat(self, start_ts: Optional[datetime] = None) -> None: ...
+    def clear_dat(self, router: str, start_ts: datetime, end_ts: datetime) -> None: ...
     def commit(self) -> None: ...
+    def rollback(self) -> None: ...
+    @property
+    def frozen_ts(self) -> Optional[datetime]: ...
+    def freeze_month(self, year: int, month: int, hourly: bool = False) -> int: ...
+    def freeze_before(self, ts: datetime, hourly: bool = False) -> Generator[Tuple[int, int, int], None, None]: ...
+    def downsample(self, hourly_ts: datetime, daily_ts: datetime) -> int: ...
     @property
     def rest_adds(self) -> Dict[str, int]: ...
     @rest_adds.setter
     def rest_adds(self, rest_adds: Dict[str, int]) -> None: ...
+    def get_state(self, name: str) -> Optional[str]: ...
+    def set_state(self, name: str, value: Optional[str]) -> None: ...
+    @property
+    def adds_applied(self) -> Dict[str, int]: ...
+    @adds_applied.setter
+    def adds_applied(self, adds_applied: Dict[str, int]) -> None: ...
+    def adds_usage(self, end_ts: datetime) -> Dict[str, int]: ...
+    def update_adds_usage(self, start_ts: Optional[datetime], usage: Iterable[Tuple[str, int, int]]) -> None: ...
+    def rows(self, start_ts: datetime, flt: Optional[str] = None,
+             direction: str = 'future') -> Generator[DataRow, None, None]: ...
     def apply_mask(self, start_ts: datetime, cb: Callable[[DataRow], Optional[bool]],
                    flt: Optional[str] = None, direction: str = 'future',
                    args: Tuple[Any, ...] = tuple()) -> None: ...
-    def update_entries(self, column: str, changes: Iterable[Tuple[int, Union[str, int]]]) -> None: ...
+    def update_entries(self, column: str, changes: Iterable[Tuple[int, Union[str, int]]],
+                       chunk_size: int = 50000) -> None: ...
+    def explain(self) -> Dict[str, List[str]]: ...
     def sum(self, start_ts: datetime, end_ts: datetime,
             flt: Optional[str] = None,
-            reference_column: str = 'host') -> Generator[Usage, None, None]: ...
+            reference_column: str = 'host',
+            args: Tuple[Any, ...] = tuple()) -> Generator[Usage, None, None]: ...
+    def sum_windows(self, start_ts: datetime, end_tss: Sequence[datetime],
+                    flt: Optional[str] = None,
+                    reference_column: str = 'host',
+                    args: Tuple[Any, ...] = tuple()) -> Generator[Tuple[Optional[Usage], ...], None, None]: ...
+    def sum_periodic(self, start_ts: datetime, end_ts: datetime, period: str,
+                     flt: Optional[str] = None,
+                     reference_column: str = 'host',
+                     args: Tuple[Any, ...] = tuple()) -> Generator[Tuple[datetime, Usage], None, None]: ...
     
 class Limit(Protocol):
     def __init__(self, name: str, amount: int, period: int) -> None: ...
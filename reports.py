@@ -2,7 +2,7 @@ import sys, time, typing
 import protocols as p
 from datetime import datetime, timedelta
 from utils import bytes2units, MiB
-from typing import Tuple, Set, Dict, List, Optional, cast
+from typing import Tuple, Set, Dict, List, Optional
 
 class AccountsReport(object):
     _limit_names: Tuple[str, ...]
@@ -24,78 +24,105 @@ class AccountsReport(object):
                 limits_set.add(acc.limit.limit(lname))
         return limits_set
 
+    # usage rows of the hosts of the accounts having a limit name, and the first account of a host, see Storage
+    _limit_hosts = '''host IN (SELECT host FROM temp.host_account JOIN temp.account_limit USING (account)
+                               WHERE limit_name = ?)'''
+    _host_account = '''(SELECT account FROM temp.host_account WHERE host_account.host = data.host
+                        ORDER BY position LIMIT 1)'''
+
+    def _period(self, limit_name: str) -> Optional[timedelta]:
+        period: Optional[timedelta] = None
+        for account in self._accounts:
+            if limit_name in account.limit.limit_names:
+                period = account.limit.period(limit_name)
+        return period
+
     def account_usage(self, start_ts: datetime, router: str, limit_name: str) -> Dict[p.Account, p.Usage]:
         result: Dict[p.Account, p.Usage] = {}
-        accounts_dict: Dict[str, p.Account] = {}
-        cases_list: List[str] = []
-        period: timedelta
+        # a host of several accounts counts for the first one having the limit, as in usage()
+        host_accounts: Dict[str, p.Account] = {}
         for account in self._accounts:
             if limit_name not in account.limit.limit_names:
                 continue
             for host in account.hosts:
-                accounts_dict[account.short] = account
-                cases_list.append("WHEN host = '%s' THEN '%s'" % (host.name, account.short))
-            period = account.limit.period(limit_name)
-        if len(cases_list) > 0:
-            the_cases = 'CASE %s ELSE NULL END' % ' '.join(cases_list)
+                host_accounts.setdefault(host.name, account)
+        period = self._period(limit_name)
+        if period is not None:
             for usage in self._storage.sum(start_ts, start_ts - period,
-                                           "router = '%s' GROUP BY (%s)" % (router, the_cases),
-                                           reference_column = '%s AS account' % the_cases):
-                if usage.ref is None: continue
-                account = accounts_dict[usage.ref]
-                result[account] = usage
+                                           "router = ? AND %s GROUP BY host" % self._limit_hosts,
+                                           args = (router, limit_name)):
+                if usage.ref not in host_accounts: continue
+                account = host_accounts[usage.ref]
+                if account in result:
+                    result[account] += usage
+                else:
+                    result[account] = usage._replace(ref = account.short)
         return result
 
     def host_usage(self, start_ts: datetime, router: str, limit_name: str) -> Dict[p.Host, p.Usage]:
         result: Dict[p.Host, p.Usage] = {}
         hosts_dict: Dict[str, p.Host] = {}
-        host_list = []
-        period: timedelta
         for account in self._accounts:
             if limit_name not in account.limit.limit_names:
                 continue
             for host in account.hosts:
-                host_list.append("host = '%s'" % host.name)
                 hosts_dict[host.name] = host
-            period = account.limit.period(limit_name)
-        if len(host_list) > 0:
-            host_filter = ' OR '.join(host_list)
+        period = self._period(limit_name)
+        if period is not None:
             for host_usage in self._storage.sum(start_ts, start_ts - period,
-                                                "(%s) AND router = '%s' GROUP BY host" % (host_filter, router)):
+                                                "router = ? AND %s GROUP BY host" % self._limit_hosts,
+                                                args = (router, limit_name)):
                 if host_usage.ref is None:
                     raise ValueError('One of the hosts is not found.')
+                if host_usage.ref not in hosts_dict: continue
                 result[hosts_dict[host_usage.ref]] = host_usage
         return result
 
+    def usage(self, start_ts: datetime, router: str) -> Tuple[Dict[str, Dict[p.Account, p.Usage]],
+                                                             Dict[str, Dict[p.Host, p.Usage]]]:
+        """Account and host usage of every limit name, like account_usage and host_usage, from one scan."""
+        account_result: Dict[str, Dict[p.Account, p.Usage]] = {}
+        host_result: Dict[str, Dict[p.Host, p.Usage]] = {}
+        periods: Dict[str, timedelta] = {}
+        host_accounts: Dict[str, Dict[str, p.Account]] = {}
+        hosts_dict: Dict[str, p.Host] = {}
+        for limit_name in self._limit_names:
+            account_result[limit_name], host_result[limit_name] = {}, {}
+            host_accounts[limit_name] = {}
+            for account in self._accounts:
+                if limit_name not in account.limit.limit_names:
+                    continue
+                for host in account.hosts:
+                    host_accounts[limit_name].setdefault(host.name, account)
+                    hosts_dict[host.name] = host
+                periods[limit_name] = account.limit.period(limit_name)
+        if len(periods) == 0: return account_result, host_result
+        limit_names = tuple(periods)
+        for windows in self._storage.sum_windows(start_ts, tuple(start_ts - periods[x] for x in limit_names),
+                                                 "router = ? AND host IN (SELECT host FROM temp.host_account)",
+                                                 args = (router,)):
+            for limit_name, usage in zip(limit_names, windows):
+                if usage is None or usage.ref not in host_accounts[limit_name]: continue
+                host_result[limit_name][hosts_dict[usage.ref]] = usage
+                account = host_accounts[limit_name][usage.ref]
+                if account in account_result[limit_name]:
+                    account_result[limit_name][account] += usage
+                else:
+                    account_result[limit_name][account] = usage._replace(ref = account.short)
+        return account_result, host_result
+
     def account_usage_periodic(self, start_ts: datetime, router: str, days: int, period: str = 'day') -> Dict[str, Dict[p.Account, p.Usage]]:
         result: Dict[str, Dict[p.Account, p.Usage]] = {}
-        accounts_dict: Dict[str, p.Account] = {}
-        cases_list: List[str] = []
-        for account in self._accounts:
-            for host in account.hosts:
-                accounts_dict[account.short] = account
-                cases_list.append("WHEN host = '%s' THEN '%s'" % (host.name, account.short))
-        if len(cases_list) > 0:
-            if period == 'year': day_exp = "'' || year"
-            elif period == 'month': day_exp = "'' || year || '-' || month"
-            elif period == 'day': day_exp = "'' || year || '-' || month || '-' || day"
-            elif period == 'hour': day_exp = "'' || year || '-' || month || '-' || day || '-' || hour"
-            else: raise ValueError('Wrong period %s, need to be one of: year, month, day, hour.' % repr(period))
-            the_cases = "(CASE %s ELSE NULL END || ' ' || %s)" % (' '.join(cases_list), day_exp)
-            for usage in self._storage.sum(start_ts, start_ts - timedelta(days = days),
-                                           "router = '%s' GROUP BY (%s), (%s) ORDER BY ref" \
-                                           % (router, the_cases, day_exp),
-                                           reference_column = '%s AS ref' % the_cases):
-                if usage.ref is None: continue
-                ref_account, ref_orig = usage.ref.split(' ')
-                ref_tuple = tuple((int(x) for x in ref_orig.split('-')))
-                if len(ref_tuple) == 1: ref_rest = cast(Tuple[int, ...], (1,1,0,0))
-                elif len(ref_tuple) == 2: ref_rest = cast(Tuple[int, ...], (1,0,0))
-                else: ref_rest = cast(Tuple[int, ...], (0,0))
-                ref_ts = datetime(*ref_tuple, *ref_rest).strftime("%Y-%m-%d %H:00") # type: ignore
+        accounts_dict = {account.short: account for account in self._accounts}
+        if len(accounts_dict) > 0:
+            for bucket, usage in self._storage.sum_periodic(start_ts, start_ts - timedelta(days = days), period,
+                                                            "router = ?", reference_column = self._host_account,
+                                                            args = (router,)):
+                if usage.ref not in accounts_dict: continue
+                ref_ts = bucket.strftime("%Y-%m-%d %H:00")
                 if ref_ts not in result:
                     result[ref_ts] = {}
-                account = accounts_dict[ref_account]
+                account = accounts_dict[usage.ref]
                 result[ref_ts][account] = usage
             dummy = p.Usage('dummy')
             for res_ts, res_accounts in result.items():
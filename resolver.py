@@ -0,0 +1,71 @@
+import os, socket, time, ipaddress, threading
+import protocols as p
+from typing import Dict, Tuple, Iterable, Optional, Callable, List
+
+DOMAIN = 'kozachuk.info'
+HOSTS_FILE = '/etc/hosts'
+
+def _ipv4(text: str) -> bool:
+    try: return isinstance(ipaddress.ip_address(text), ipaddress.IPv4Address)
+    except ValueError: return False
+
+class Resolver(object):
+    """IPv4 addresses of host names for the firewall. Addresses from Host.ips and the hosts file never expire,
+    the others are looked up in DNS in the background and kept for ttl seconds, an expired one is still used
+    until the new lookup succeeds. Lookups run in daemon threads, one hanging does not keep the process alive.
+    IPv6 addresses are not looked up, the firewall rules only match IPv4."""
+    def __init__(self, hosts: Iterable[p.Host],
+                 hosts_file: Optional[str] = HOSTS_FILE,
+                 ttl: float = 3600,
+                 timeout: float = 2,
+                 lookup: Callable[[str], str] = socket.gethostbyname) -> None:
+        self._ttl = ttl
+        self._timeout = timeout
+        self._lookup = lookup
+        # name: (address, expiry in time.monotonic())
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        # name: set when its lookup finishes
+        self._pending: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        names = set()
+        for host in hosts:
+            names.add(host.name)
+            for ip in host.ips:
+                if _ipv4(ip) and host.name not in self._cache:
+                    self._cache[host.name] = (ip, float('inf'))
+        if hosts_file is not None and os.path.exists(hosts_file):
+            with open(hosts_file) as fd:
+                for line in fd:
+                    fields = line.split('#')[0].split()
+                    if len(fields) < 2 or not _ipv4(fields[0]): continue
+                    for name in fields[1:]:
+                        if name.endswith('.' + DOMAIN): name = name[:-len(DOMAIN) - 1]
+                        if name in names and name not in self._cache:
+                            self._cache[name] = (fields[0], float('inf'))
+
+    def _resolve(self, name: str, done: threading.Event) -> None:
+        try: address = self._lookup('%s.%s' % (name, DOMAIN))
+        except OSError: address = None
+        with self._lock:
+            if address is not None:
+                self._cache[name] = (address, time.monotonic() + self._ttl)
+            del self._pending[name]
+        done.set()
+
+    def addresses(self, names: Iterable[str]) -> Dict[str, str]:
+        """Addresses of the names known now or found within timeout, names still unknown are left out."""
+        names = list(names)
+        now = time.monotonic()
+        waiting: List[threading.Event] = []
+        with self._lock:
+            for name in names:
+                entry = self._cache.get(name)
+                if entry is not None and entry[1] >= now: continue
+                if name not in self._pending:
+                    self._pending[name] = threading.Event()
+                    threading.Thread(target = self._resolve, args = (name, self._pending[name]), daemon = True).start()
+                if entry is None: waiting.append(self._pending[name])
+        deadline = now + self._timeout
+        for done in waiting: done.wait(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            return {name: self._cache[name][0] for name in names if name in self._cache}
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3.8
+
+import sys, time, os
+from storage import Storage
+from datetime import datetime as dt, timedelta as td
+from data_config import accounts
+
+timing = time.monotonic()
+def t() -> str: return "%ds" % int(time.monotonic() - timing)
+
+if len(sys.argv) != 5:
+    sys.stderr.write('Usage: %s <minute_days> <hourly_months> <directory> <dbfile>\n' % sys.argv[0])
+    sys.exit(1)
+
+minute_days = int(sys.argv[1])
+hourly_months = int(sys.argv[2])
+directory = sys.argv[3]
+db_file = sys.argv[4]
+pid = os.getpid()
+
+now = dt.now()
+hourly_ts = dt(now.year, now.month, now.day) - td(days = minute_days)
+month = now.year * 12 + now.month - 1 - hourly_months
+daily_ts = dt(month // 12, month % 12 + 1, 1)
+
+print(pid, t(), 'load data from file %s' % repr(db_file), flush = True)
+storage = Storage(db_file, accounts, directory, True, 'ingest')
+
+print(pid, t(), 'downsample to hours before %s and to days before %s' % (hourly_ts.strftime('%Y-%m-%d'),
+                                                                       daily_ts.strftime('%Y-%m-%d')), flush = True)
+print(pid, t(), '%d rows removed' % storage.downsample(hourly_ts, daily_ts), flush = True)
+
+print(pid, t(), 'finish retain data process', flush = True)
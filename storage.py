@@ -1,10 +1,64 @@
-import sqlite3, os, sys, protocols, hashlib
+import sqlite3, os, re, sys, protocols, dayfile, functools, itertools
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
 from datetime import datetime, timedelta
-from utils import ts2filter
-from typing import Tuple, Optional, List, Callable, Any, Generator, Iterable, Union, Dict
+from utils import ts2minute, minute2ts
+from dayfile import InputRow
+from typing import Tuple, Optional, List, Callable, Any, Generator, Iterable, Union, Dict, Sequence, cast
 
 DataRow = protocols.DataRow
-InputRow = Tuple[int, int, int, int, int, Optional[str], str]
+
+FileJob = Tuple[str, str, int, int, int]
+ROLLUPS = (('usage_hourly', 60), ('usage_daily', 1440))
+# connection profiles, name: (read only, pragmas); the ingest profile switches the database file to WAL
+# so the report profile readers, opening it read only, neither block nor get blocked by the writer
+PROFILES: Dict[str, Tuple[bool, Tuple[Tuple[str, Union[str, int]], ...]]] = {
+    'default': (False, ()),
+    'ingest': (False, (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('temp_store', 'MEMORY'),
+                       ('cache_size', -256 * 1024), ('mmap_size', 1024 ** 3))),
+    'report': (True, (('temp_store', 'MEMORY'), ('cache_size', -64 * 1024), ('mmap_size', 1024 ** 3))),
+}
+DATA_MINUTES = '''CREATE TABLE %sdata_minutes(id INTEGER PRIMARY KEY AUTOINCREMENT, host_id INTEGER, ts INTEGER,
+                                               dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER,
+                                               dat INTEGER, router_id INTEGER, dat_id BLOB)'''
+# month shards attached at once, SQLite allows 10 attached databases by default; queries over more months
+# run piece by piece
+MAX_SHARDS = 8
+# besides the unique data_dat_id: time ranges of loading and the add replay,
+# and router + time range grouped by host of the usage queries, covering the summed columns
+DATA_INDEXES = (('ts', 'ts'), ('usage', 'router_id, ts, host_id, dat_in, dat_out, dat_pkg, dat'))
+ParsedFile = Tuple[List[InputRow], int, int]
+
+def _parse_job(routers: Tuple[str, ...], job: FileJob) -> ParsedFile:
+    fname, _, _, position, lines = job
+    if fname.endswith(dayfile.SUFFIX):
+        return dayfile.parse_binary_file(fname, routers, position, lines)
+    return dayfile.parse_data_file(fname, position, lines)
+
+def _pack_dat_id(dat_id: Optional[str]) -> Union[None, str, bytes]:
+    """Hex dat_ids as written by the collectors are stored as blobs, anything else as it is."""
+    if dat_id is None: return None
+    try: packed = bytes.fromhex(dat_id)
+    except ValueError: return dat_id
+    return packed if packed.hex() == dat_id else dat_id
+
+def _merge(rows: Iterable[Tuple[Any, ...]], keys: int) -> List[Tuple[Any, ...]]:
+    """Rows of a query run piece by piece merged by their first keys columns, the other columns summed as SUM() does."""
+    merged: Dict[Tuple[Any, ...], List[Any]] = {}
+    for row in rows:
+        sums = merged.setdefault(row[:keys], [None] * (len(row) - keys))
+        for n, value in enumerate(row[keys:]):
+            if value is not None: sums[n] = value if sums[n] is None else sums[n] + value
+    return [key + tuple(sums) for key, sums in merged.items()]
+
+def _data_select(schema: str = '') -> str:
+    """Rows of the data view from the data_minutes of schema, the host and router names always come from main."""
+    names = 'main.' if len(schema) > 0 else ''
+    return '''SELECT %sdata_minutes.id AS id, hosts.name AS host, ts, dat_in, dat_out, dat_pkg, dat,
+                     routers.name AS router,
+                     CASE typeof(dat_id) WHEN 'blob' THEN lower(hex(dat_id)) ELSE dat_id END AS dat_id
+              FROM %sdata_minutes JOIN %shosts AS hosts ON hosts.id = host_id
+                                  JOIN %srouters AS routers ON routers.id = router_id''' % (schema, schema, names, names)
 
 class Entry(protocols.Entry):
     def __init__(self) -> None: pass
@@ -17,160 +71,598 @@ class Entry(protocols.Entry):
     @property
     def host(self) -> str: return self._row[1]
     @property
-    def year(self) -> int: return self._row[2]
+    def ts_minute(self) -> int: return self._row[2]
+    @property
+    def year(self) -> int: return self.ts.year
     @property
-    def month(self) -> int: return self._row[3]
+    def month(self) -> int: return self.ts.month
     @property
-    def day(self) -> int: return self._row[4]
+    def day(self) -> int: return self.ts.day
     @property
-    def hour(self) -> int: return self._row[5]
+    def hour(self) -> int: return self.ts.hour
     @property
-    def minute(self) -> int: return self._row[6]
+    def minute(self) -> int: return self.ts.minute
     @property
-    def dat_in(self) -> int: return self._row[7]
+    def dat_in(self) -> int: return self._row[3]
     @property
-    def dat_out(self) -> int: return self._row[8]
+    def dat_out(self) -> int: return self._row[4]
     @property
-    def dat_pkg(self) -> int: return self._row[9]
+    def dat_pkg(self) -> int: return self._row[5]
     @property
-    def dat(self) -> int: return self._row[10]
+    def dat(self) -> int: return self._row[6]
     @property
-    def router(self) -> str: return self._row[11]
+    def router(self) -> str: return self._row[7]
     @property
-    def ts(self) -> datetime:
-        return datetime(self.year, self.month, self.day, self.hour, self.minute)
+    def ts(self) -> datetime: return minute2ts(self._row[2])
 
 class Storage(protocols.Storage):
     def __init__(self, fname: str,
                  accounts: Tuple[protocols.Account, ...],
                  data_path: str,
-                 create_db: bool) -> None:
+                 create_db: bool,
+                 profile: str = 'default') -> None:
         self._data_path = data_path
         self._accounts = accounts
         for acc in self._accounts:
             acc._set_storage(self)
-        self._conn = sqlite3.connect(fname)
+        if profile not in PROFILES:
+            raise ValueError('Profile %s unknown, need to be one of: %s.' % (repr(profile), ', '.join(PROFILES)))
+        readonly, pragmas = PROFILES[profile]
+        self._fname, self._readonly = fname, readonly
+        if readonly and create_db:
+            raise ValueError('Profile %s is read only and cannot create the database.' % repr(profile))
+        if readonly and fname != ':memory:':
+            self._conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(fname)), uri = True)
+        else: self._conn = sqlite3.connect(fname)
         c = self._conn.cursor()
+        for name, value in pragmas:
+            c.execute('PRAGMA %s = %s' % (name, value))
         if create_db:
-            try: c.execute('''CREATE TABLE data(id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT,
-                                                year INTEGER, month INTEGER, day INTEGER, hour INTEGER, minute INTEGER,
-                                                dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER,
-                                                dat INTEGER, router TEXT, dat_id TEXT) ''')
-            except sqlite3.OperationalError as err:
-                if str(err) != 'table data already exists': raise err
-            try: c.execute('''CREATE UNIQUE INDEX data_dat_id ON data(dat_id)''')
-            except sqlite3.OperationalError as err:
-                if str(err) != 'index data_dat_id already exists': raise err
-            for col in ('host', 'year', 'month', 'day', 'hour', 'minute', 'router'):
-                try: c.execute('''CREATE INDEX data_%s ON DATA(%s)''' % (col, col))
-                except sqlite3.OperationalError as err:
-                    if str(err) != 'index data_%s already exists' % col:
-                        raise err
-            try: c.execute('''CREATE TABLE files(name TEXT, mtime TEXT)''')
+            try: c.execute('''CREATE TABLE files(name TEXT, mtime TEXT, position INTEGER, inode INTEGER, lines INTEGER)''')
             except sqlite3.OperationalError as err:
                 if str(err) != 'table files already exists': raise err
             try: c.execute('''CREATE UNIQUE INDEX files_name ON files(name)''')
             except sqlite3.OperationalError as err:
                 if str(err) != 'index files_name already exists': raise err
+            files_columns = set(x[1] for x in c.execute('''PRAGMA table_info(files)''').fetchall())
+            for col in ('position', 'inode', 'lines'):
+                if col not in files_columns:
+                    c.execute('''ALTER TABLE files ADD COLUMN %s INTEGER''' % col)
             try: c.execute('''CREATE TABLE rest_adds(name TEXT, amount INTEGER)''')
             except sqlite3.OperationalError as err:
                 if str(err) != 'table rest_adds already exists': raise err
-            self._conn.commit()
-        self._cols = ('host', 'year', 'month', 'day', 'hour', 'minute', 'dat_in', 'dat_out', 'dat_pkg', 'dat', 'router', 'dat_id')
-        self._load_sql = '''INSERT INTO data(%s) VALUES(%s)''' \
-            % (",".join(self._cols), ",".join(['?' for _ in self._cols]))
-        self._known_ids = set(x[0] for x in c.execute('''SELECT dat_id FROM data''').fetchall())
-        self._known_files = set((x[0], x[1]) for x in c.execute('''SELECT name, mtime FROM files''').fetchall())
-
-    def _read_data_file(self, fname: str) -> List[InputRow]:
-        result: List[InputRow] = []
-        if not os.path.exists(fname): return result
-        mtime = str(os.stat(fname).st_mtime)
-        if (fname, mtime) in self._known_files: return result
-        id_int = int.from_bytes(hashlib.shake_256(fname.encode('utf-8')).digest(11), 'big')
-        with open(fname) as fd:
-            for line in fd:
-                id_int += 1
-                line = line.replace('\0', '').strip()
-                if len(line) == 0: continue
-                data_router: Optional[str] = None
-                try:
-                    data = line.split(' ')
-                    if len(data) == 7:
-                        hour, minute, data_in, data_out, data_pkg, data_router, dat_id = \
-                            int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4]), data[5], data[6]
-                    elif len(data) == 6:
-                        hour, minute, data_in, data_out, data_pkg, data_router = \
-                            int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4]), data[5]
-                        dat_id = id_int.to_bytes(11, 'big').hex()
-                    elif len(data) == 5:
-                        hour, minute, data_in, data_out, data_pkg = \
-                            int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4])
-                        dat_id = id_int.to_bytes(11, 'big').hex()
-                    else: raise RuntimeError("wrong line format: %s" % repr(data))
-                except Exception as err:
-                    sys.stderr.write("ERROR on parsing %s: %s\n" % (repr(fname), repr(err)))
+            try: c.execute('''CREATE TABLE state(name TEXT PRIMARY KEY, value TEXT)''')
+            except sqlite3.OperationalError as err:
+                if str(err) != 'table state already exists': raise err
+            try: c.execute('''CREATE TABLE adds_applied(name TEXT PRIMARY KEY, ts INTEGER)''')
+            except sqlite3.OperationalError as err:
+                if str(err) != 'table adds_applied already exists': raise err
+            try: c.execute('''CREATE TABLE adds_usage(name TEXT, ts INTEGER, amount INTEGER)''')
+            except sqlite3.OperationalError as err:
+                if str(err) != 'table adds_usage already exists': raise err
+            try: c.execute('''CREATE INDEX adds_usage_ts ON adds_usage(ts)''')
+            except sqlite3.OperationalError as err:
+                if str(err) != 'index adds_usage_ts already exists': raise err
+            try: c.execute('''CREATE TABLE shards(first INTEGER PRIMARY KEY, last INTEGER, name TEXT, resolution INTEGER)''')
+            except sqlite3.OperationalError as err:
+                if str(err) != 'table shards already exists': raise err
+        self._dirty: Optional[Tuple[int, int]] = None
+        self._queries: Dict[Tuple[str, Optional[str]], Tuple[str, Tuple[Any, ...]]] = {}
+        # staging area of update_entries, private to this connection
+        c.execute('''CREATE TEMP TABLE entry_changes(id INTEGER PRIMARY KEY, value)''')
+        # staging area of _aggregate
+        c.execute('''CREATE TEMP TABLE aggregates(id INTEGER PRIMARY KEY, host_id INTEGER, ts INTEGER,
+                                                  dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER, dat INTEGER, router_id INTEGER)''')
+        # host to account short names by the position of the account, a host may be in several accounts,
+        # and the limit names of every account, as configured, for the reports
+        c.execute('''CREATE TEMP TABLE host_account(host TEXT, position INTEGER, account TEXT,
+                                                    PRIMARY KEY (host, position)) WITHOUT ROWID''')
+        c.execute('''CREATE TEMP TABLE account_limit(account TEXT, limit_name TEXT, PRIMARY KEY (limit_name, account))''')
+        c.executemany('''INSERT OR IGNORE INTO temp.host_account(host, position, account) VALUES (?,?,?)''',
+                      [(host.name, position, acc.short) for position, acc in enumerate(self._accounts) for host in acc.hosts])
+        c.executemany('''INSERT OR IGNORE INTO temp.account_limit(account, limit_name) VALUES (?,?)''',
+                      [(acc.short, lname) for acc in self._accounts for lname in acc.limit.limit_names])
+        self._dimension_ids: Dict[str, Dict[str, int]] = {'hosts': {}, 'routers': {}}
+        self._conn.create_function('pack_dat_id', 1, _pack_dat_id, deterministic = True)
+        if not readonly:
+            self._migrate_minute_columns()
+            self._migrate_dimension_columns()
+        elif c.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data' ''').fetchone() is not None:
+            self._conn.close()
+            raise ValueError('Database %s has the old data table, open it with a writable profile to migrate it first.'
+                             % repr(fname))
+        if create_db:
+            self._create_data_tables()
+            self._create_data_indexes()
+            for table, _ in ROLLUPS:
+                try: c.execute('''CREATE TABLE %s(router TEXT, host TEXT, bucket INTEGER,
+                                                  dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER, dat INTEGER,
+                                                  PRIMARY KEY (router, bucket, host)) WITHOUT ROWID''' % table)
+                except sqlite3.OperationalError as err:
+                    if str(err) != 'table %s already exists' % table: raise err
                     continue
-                if data_router ==  'mikrotik' and (data_in + data_out) < data_pkg:
-                    # temporary to fix bug (2020-02-10)
-                    data_in, data_pkg = data_pkg, data_in
-                if dat_id not in self._known_ids:
-                    result.append((hour, minute, data_in, data_out, data_pkg, data_router, dat_id))
+                # new rollup table on an existing database, build it from all rows
+                self._mark_dirty(*c.execute('''SELECT MIN(ts), MAX(ts) FROM data''').fetchone())
+        self._load_shards()
+        # also ends the transaction filling the temp tables, an open one would pin a reader to its snapshot
+        self._conn.commit()
+        self._cols = ('host', 'ts', 'dat_in', 'dat_out', 'dat_pkg', 'dat', 'router', 'dat_id')
+        self._load_sql = '''INSERT OR IGNORE INTO data_minutes(host_id, ts, dat_in, dat_out, dat_pkg, dat, router_id, dat_id)
+                            VALUES(?,?,?,?,?,?,?,?)'''
+
+    def _create_data_tables(self) -> None:
+        """Minute rows keyed by host and router ids, and the data view resolving their names."""
+        c = self._conn.cursor()
+        for table in ('hosts', 'routers'):
+            try: c.execute('''CREATE TABLE %s(id INTEGER PRIMARY KEY, name TEXT UNIQUE)''' % table)
+            except sqlite3.OperationalError as err:
+                if str(err) != 'table %s already exists' % table: raise err
+        # rows without a router refer to the nameless router 0, so the view can use inner joins
+        c.execute('''INSERT OR IGNORE INTO routers(id, name) VALUES (0, NULL)''')
+        try: c.execute(DATA_MINUTES % '')
+        except sqlite3.OperationalError as err:
+            if str(err) != 'table data_minutes already exists': raise err
+        try: c.execute('''CREATE VIEW data AS %s''' % _data_select())
+        except sqlite3.OperationalError as err:
+            if str(err) != 'view data already exists': raise err
+
+    def _load_shards(self) -> None:
+        c = self._conn.cursor()
+        self._attached: Dict[int, str] = {}
+        try: self._shards: List[Tuple[int, int, str, int]] = \
+            c.execute('''SELECT first, last, name, resolution FROM shards ORDER BY first''').fetchall()
+        except sqlite3.OperationalError as err:
+            if str(err) != 'no such table: shards': raise err
+            self._shards = []
+
+    def _shard_path(self, name: str) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(self._fname)), name)
+
+    @property
+    def frozen_ts(self) -> Optional[datetime]:
+        """Rows before it are final, moved into month shards or downsampled, and neither loaded nor changed again."""
+        ends = [self._shards[-1][1] + 1] if len(self._shards) > 0 else []
+        hourly = self.get_state('hourly_ts')
+        if hourly is not None: ends.append(int(hourly))
+        return minute2ts(max(ends)) if len(ends) > 0 else None
+
+    def _pieces(self, first: int, last: int) -> List[Tuple[int, int]]:
+        """Split the minute range at month shard boundaries into pieces overlapping at most MAX_SHARDS shards each,
+        a query over more months runs piece by piece."""
+        needed = [x for x in self._shards if x[0] <= last and x[1] >= first]
+        starts = [x[0] for x in needed[MAX_SHARDS::MAX_SHARDS]]
+        return list(zip([first] + starts, [x - 1 for x in starts] + [last]))
+
+    def _attach_shards(self, *ranges: Tuple[int, int]) -> None:
+        """Make the data view cover the month shards overlapping the minute ranges."""
+        needed = [x for x in self._shards if any(x[0] <= last and x[1] >= first for first, last in ranges)]
+        if all(x[0] in self._attached for x in needed): return
+        if len(needed) > MAX_SHARDS:
+            raise ValueError('The ranges cover %d month shards, at most %d can be attached at once.' % (len(needed), MAX_SHARDS))
+        # ATTACH and DETACH are refused inside a transaction, committing it here would commit the caller's changes halfway
+        if self._conn.in_transaction:
+            raise RuntimeError('Month shards can not be attached inside a transaction, commit first.')
+        c = self._conn.cursor()
+        if len(self._attached) + len(needed) > MAX_SHARDS:
+            for first in [x for x in self._attached if all(x != y[0] for y in needed)]:
+                c.execute('''DETACH DATABASE %s''' % self._attached.pop(first))
+        for first, _, name, _ in needed:
+            if first in self._attached: continue
+            path = self._shard_path(name)
+            if self._readonly: path = 'file:%s?mode=ro' % pathname2url(path)
+            schema = 'shard_%s' % minute2ts(first).strftime('%Y%m')
+            c.execute('''ATTACH DATABASE ? AS %s''' % schema, (path,))
+            self._attached[first] = schema
+        # the temp view shadows the main one for the unqualified name data
+        c.execute('''DROP VIEW IF EXISTS temp.data''')
+        c.execute('''CREATE TEMP VIEW data AS %s''' \
+                  % ' UNION ALL '.join([_data_select('main.')] + [_data_select('%s.' % x) for x in self._attached.values()]))
+
+    def freeze_month(self, year: int, month: int, hourly: bool = False) -> int:
+        """Move the minute rows of a closed month into a vacuumed shard file next to the database, with hourly
+        compacted to one row per router, host and hour. Returns the number of rows moved."""
+        if self._fname == ':memory:':
+            raise ValueError('An in-memory database has no month shards.')
+        first = ts2minute(datetime(year, month, 1))
+        last = ts2minute(datetime(year + month // 12, month % 12 + 1, 1)) - 1
+        now = datetime.now()
+        if last >= ts2minute(datetime(now.year, now.month, 1)):
+            raise ValueError('Month %04d-%02d is not closed yet.' % (year, month))
+        if len(self._shards) > 0 and self._shards[-1][1] >= first:
+            raise ValueError('Month %04d-%02d is frozen already.' % (year, month))
+        c = self._conn.cursor()
+        if c.execute('''SELECT COUNT(*) FROM data_minutes WHERE ts < ?''', (first,)).fetchone()[0] > 0:
+            raise ValueError('Freeze the months before %04d-%02d first.' % (year, month))
+        self.commit()
+        name = '%s.%04d%02d' % (os.path.basename(self._fname), year, month)
+        path = self._shard_path(name)
+        if os.path.exists(path):
+            raise ValueError('Shard %s exists already.' % repr(path))
+        c.execute('''ATTACH DATABASE ? AS freeze''', (path,))
+        try:
+            c.execute(DATA_MINUTES % 'freeze.')
+            if hourly:
+                # an hourly row keeps the lowest id of its minute rows, ids stay unique across main and the shards
+                c.execute('''INSERT INTO freeze.data_minutes(id, host_id, ts, dat_in, dat_out, dat_pkg, dat, router_id)
+                             SELECT MIN(id), host_id, ts / 60 * 60, SUM(dat_in), SUM(dat_out), SUM(dat_pkg), SUM(dat), router_id
+                             FROM main.data_minutes WHERE ts BETWEEN ? AND ? GROUP BY router_id, host_id, ts / 60''',
+                          (first, last))
+            else:
+                c.execute('''INSERT INTO freeze.data_minutes SELECT * FROM main.data_minutes WHERE ts BETWEEN ? AND ?''',
+                          (first, last))
+            for index, cols in DATA_INDEXES:
+                c.execute('''CREATE INDEX freeze.data_%s ON data_minutes(%s)''' % (index, cols))
+            moved = c.execute('''DELETE FROM main.data_minutes WHERE ts BETWEEN ? AND ?''', (first, last)).rowcount
+            c.execute('''INSERT INTO shards(first, last, name, resolution) VALUES (?,?,?,?)''',
+                      (first, last, name, 60 if hourly else 1))
+            self._compact_adds_usage(last + 1)
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            c.execute('''DETACH DATABASE freeze''')
+            os.unlink(path)
+            raise
+        c.execute('''DETACH DATABASE freeze''')
+        shard = sqlite3.connect(path)
+        shard.execute('''VACUUM''')
+        shard.close()
+        for schema in self._attached.values():
+            c.execute('''DETACH DATABASE %s''' % schema)
+        c.execute('''DROP VIEW IF EXISTS temp.data''')
+        self._load_shards()
+        return moved
+
+    def _compact_adds_usage(self, before: int) -> None:
+        """Keep one adds consumption row per name before the minute before, the frozen rows are never replayed
+        and update_adds_usage() no longer replaces them."""
+        c = self._conn.cursor()
+        rows = c.execute('''SELECT name, MAX(ts), SUM(amount) FROM adds_usage WHERE ts < ? GROUP BY name HAVING COUNT(*) > 1''',
+                         (before,)).fetchall()
+        c.executemany('''DELETE FROM adds_usage WHERE name = ? AND ts < ?''', [(name, before) for name, _, _ in rows])
+        c.executemany('''INSERT INTO adds_usage(name, ts, amount) VALUES (?,?,?)''', rows)
+
+    def freeze_before(self, ts: datetime, hourly: bool = False) -> Generator[Tuple[int, int, int], None, None]:
+        """Freeze every month with minute rows that ends before ts, yields year, month and the rows moved."""
+        first = self._conn.cursor().execute('''SELECT MIN(ts) FROM data_minutes''').fetchone()[0]
+        if first is None: return
+        first_ts = minute2ts(first)
+        for month in range(first_ts.year * 12 + first_ts.month - 1, ts.year * 12 + ts.month - 1):
+            year, month = divmod(month, 12)
+            yield year, month + 1, self.freeze_month(year, month + 1, hourly)
+
+    def _aggregate(self, schema: str, first: int, last: int, size: int) -> int:
+        """Replace the rows of schema between the minutes first and last by one row per router, host and bucket
+        of size minutes. Returns the number of rows removed."""
+        c = self._conn.cursor()
+        # an aggregate keeps the lowest id of its rows, fresh AUTOINCREMENT ids of a shard could be taken in main
+        c.execute('''INSERT INTO temp.aggregates(id, host_id, ts, dat_in, dat_out, dat_pkg, dat, router_id)
+                     SELECT MIN(id), host_id, ts / %d * %d, SUM(dat_in), SUM(dat_out), SUM(dat_pkg), SUM(dat), router_id
+                     FROM %sdata_minutes WHERE ts BETWEEN ? AND ? GROUP BY router_id, host_id, ts / %d''' \
+                  % (size, size, schema, size), (first, last))
+        removed = c.execute('''DELETE FROM %sdata_minutes WHERE ts BETWEEN ? AND ?''' % schema, (first, last)).rowcount
+        added = c.execute('''INSERT INTO %sdata_minutes SELECT id, host_id, ts, dat_in, dat_out, dat_pkg, dat, router_id, NULL
+                             FROM temp.aggregates''' % schema).rowcount
+        c.execute('''DELETE FROM temp.aggregates''')
+        return removed - added
+
+    def downsample(self, hourly_ts: datetime, daily_ts: datetime) -> int:
+        """Keep one row per router, host and hour before hourly_ts and one per router, host and day before daily_ts,
+        in the database and its month shards. The boundaries are rounded down to whole hours and days, so sums
+        over whole hours before hourly_ts and whole days before daily_ts stay exact. The hourly rollup is dropped
+        before daily_ts. Returns the number of rows removed."""
+        daily = ts2minute(daily_ts) // 1440 * 1440
+        hourly = max(ts2minute(hourly_ts) // 60 * 60, daily)
+        # rows before the boundaries of earlier runs are aggregated already
+        daily_done = int(self.get_state('daily_ts') or -1)
+        hourly_done = max(int(self.get_state('hourly_ts') or -1), daily_done)
+        steps = [(first, last, size) for first, last, size in ((daily_done, daily - 1, 1440),
+                                                               (max(hourly_done, daily), hourly - 1, 60)) if first <= last]
+        if len(steps) == 0: return 0
+        self.commit()
+        c = self._conn.cursor()
+        for schema in self._attached.values():
+            c.execute('''DETACH DATABASE %s''' % schema)
+        self._attached = {}
+        c.execute('''DROP VIEW IF EXISTS temp.data''')
+        removed = 0
+        for first, last, size in steps:
+            removed += self._aggregate('main.', first, last, size)
+        self.set_state('daily_ts', str(max(daily, daily_done)))
+        self.set_state('hourly_ts', str(max(hourly, hourly_done)))
+        c.execute('''DELETE FROM usage_hourly WHERE bucket < ?''', (daily,))
+        self._compact_adds_usage(hourly)
+        self._conn.commit()
+        for shard_first, shard_last, name, resolution in self._shards:
+            shard_steps = [x for x in steps if x[0] <= shard_last and x[1] >= shard_first]
+            if len(shard_steps) == 0: continue
+            path = self._shard_path(name)
+            c.execute('''ATTACH DATABASE ? AS retain''', (path,))
+            try:
+                for first, last, size in shard_steps:
+                    removed += self._aggregate('retain.', max(first, shard_first), min(last, shard_last), size)
+                    if first <= shard_first and last >= shard_last: resolution = max(resolution, size)
+                c.execute('''UPDATE shards SET resolution = ? WHERE first = ?''', (resolution, shard_first))
+                self._conn.commit()
+            finally:
+                c.execute('''DETACH DATABASE retain''')
+            shard = sqlite3.connect(path)
+            shard.execute('''VACUUM''')
+            shard.close()
+        self._load_shards()
+        return removed
+
+    def _dimension_id(self, table: str, name: Optional[str]) -> int:
+        if name is None: return 0
+        ids = self._dimension_ids[table]
+        if name not in ids:
+            c = self._conn.cursor()
+            c.execute('''INSERT OR IGNORE INTO %s(name) VALUES (?)''' % table, (name,))
+            ids[name] = c.execute('''SELECT id FROM %s WHERE name = ?''' % table, (name,)).fetchone()[0]
+        return ids[name]
+
+    def _create_data_indexes(self) -> None:
+        """Create the indexes of DATA_INDEXES and drop any other data_* index left from older layouts."""
+        c = self._conn.cursor()
+        try: c.execute('''CREATE UNIQUE INDEX data_dat_id ON data_minutes(dat_id)''')
+        except sqlite3.OperationalError as err:
+            if str(err) != 'index data_dat_id already exists': raise err
+        for name, cols in DATA_INDEXES:
+            try: c.execute('''CREATE INDEX data_%s ON data_minutes(%s)''' % (name, cols))
+            except sqlite3.OperationalError as err:
+                if str(err) != 'index data_%s already exists' % name:
+                    raise err
+        wanted = set(['data_dat_id'] + ['data_%s' % name for name, _ in DATA_INDEXES])
+        for name, in c.execute('''SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'data_minutes'
+                                  AND name LIKE 'data\\_%' ESCAPE '\\' ''').fetchall():
+            if name not in wanted:
+                c.execute('''DROP INDEX %s''' % name)
+
+    def _migrate_minute_columns(self) -> None:
+        """Convert the old year/month/day/hour/minute layout into one epoch-minute ts column."""
+        c = self._conn.cursor()
+        columns = set(x[1] for x in c.execute('''PRAGMA table_info(data)''').fetchall())
+        if 'year' not in columns or 'ts' in columns: return
+        sys.stderr.write("migrate table data to epoch-minute timestamps\n")
+        c.execute('''CREATE TABLE data_new(id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT, ts INTEGER,
+                                            dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER,
+                                            dat INTEGER, router TEXT, dat_id TEXT)''')
+        c.execute('''INSERT INTO data_new(id, host, ts, dat_in, dat_out, dat_pkg, dat, router, dat_id)
+                     SELECT id, host,
+                            CAST(strftime('%s', printf('%04d-%02d-%02d %02d:%02d', year, month, day, hour, minute)) AS INTEGER) / 60,
+                            dat_in, dat_out, dat_pkg, dat, router, dat_id FROM data''')
+        c.execute('''DROP TABLE data''')
+        c.execute('''ALTER TABLE data_new RENAME TO data''')
+        self._conn.commit()
+
+    def _migrate_dimension_columns(self) -> None:
+        """Move a data table with text host, router and dat_id columns into data_minutes."""
         c = self._conn.cursor()
-        try: c.execute('INSERT INTO files(name, mtime) VALUES(?,?)', (fname, mtime))
+        if c.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data' ''').fetchone() is None: return
+        sys.stderr.write("migrate table data to host and router ids\n")
+        c.execute('''ALTER TABLE data RENAME TO data_text''')
+        self._create_data_tables()
+        c.execute('''INSERT OR IGNORE INTO hosts(name) SELECT DISTINCT host FROM data_text WHERE host IS NOT NULL''')
+        c.execute('''INSERT OR IGNORE INTO routers(name) SELECT DISTINCT router FROM data_text WHERE router IS NOT NULL''')
+        # rows without a host have no host id, the rollups could not key them either
+        dropped = c.execute('''SELECT COUNT(*) FROM data_text WHERE host IS NULL''').fetchone()[0]
+        if dropped > 0: sys.stderr.write("drop %d rows without a host\n" % dropped)
+        c.execute('''INSERT INTO data_minutes(id, host_id, ts, dat_in, dat_out, dat_pkg, dat, router_id, dat_id)
+                     SELECT data_text.id, hosts.id, ts, dat_in, dat_out, dat_pkg, dat,
+                            IFNULL(routers.id, 0), pack_dat_id(dat_id)
+                     FROM data_text JOIN hosts ON hosts.name = data_text.host
+                                    LEFT JOIN routers ON routers.name = data_text.router''')
+        c.execute('''DROP TABLE data_text''')
+        self._create_data_indexes()
+        self._conn.commit()
+
+    def _file_job(self, fname: str) -> Optional[FileJob]:
+        if not os.path.exists(fname): return None
+        stat = os.stat(fname)
+        mtime = str(stat.st_mtime)
+        c = self._conn.cursor()
+        known = c.execute('''SELECT mtime, position, inode, lines FROM files WHERE name = ?''', (fname,)).fetchone()
+        if known is not None and known[0] == mtime: return None
+        position, lines = 0, 0
+        if known is not None and known[1] is not None \
+           and known[2] == stat.st_ino and known[1] <= stat.st_size:
+            # same file grown by appends, continue after the consumed part
+            position, lines = known[1], known[3]
+        return fname, mtime, stat.st_ino, position, lines
+
+    def _file_done(self, job: FileJob, position: int, lines: int) -> None:
+        fname, mtime, inode, _, _ = job
+        c = self._conn.cursor()
+        try: c.execute('''INSERT INTO files(name, mtime, position, inode, lines) VALUES(?,?,?,?,?)''',
+                       (fname, mtime, position, inode, lines))
         except sqlite3.IntegrityError as err:
             if str(err) != 'UNIQUE constraint failed: files.name': raise err
-            c.execute('UPDATE files SET mtime = ? WHERE name = ?', (mtime, fname))
-        return result
+            c.execute('''UPDATE files SET mtime = ?, position = ?, inode = ?, lines = ? WHERE name = ?''',
+                      (mtime, position, inode, lines, fname))
 
-    def _load_one_day(self, start_ts: datetime, day_offset: int) -> None:
+    def _day_jobs(self, start_ts: datetime, day_offset: int) -> Generator[Tuple[str, int, FileJob], None, None]:
         td = timedelta(days = day_offset)
         ts = start_ts + td
         fname = 'day_%02d%02d%02d' % (ts.year, ts.month, ts.day)
-        one_day_data = []
+        day_minute = ts2minute(datetime(ts.year, ts.month, ts.day))
         for account in self._accounts:
             for host in account.hosts:
                 for hostname in host.namelist:
-                    today_file = os.path.join(self._data_path, hostname, fname)
-                    for hour, minute, dat_in, dat_out, dat_pkg, router, dat_id in self._read_data_file(today_file):
-                        if datetime(ts.year, ts.month, ts.day, hour, minute) > start_ts: continue
-                        one_day_data.append((hostname, ts.year, ts.month, ts.day, hour, minute,
-                                             dat_in, dat_out, dat_pkg, dat_in + dat_out, router, dat_id))
+                    for day_file in (fname, dayfile.binary_name(fname)):
+                        job = self._file_job(os.path.join(self._data_path, hostname, day_file))
+                        if job is not None:
+                            yield hostname, day_minute, job
+
+    def _changed_jobs(self, start_ts: datetime, days: int,
+                      changed: Iterable[str]) -> Generator[Tuple[str, int, FileJob], None, None]:
+        """Jobs of the changed paths that are day files of a known host within the days up to start_ts."""
+        hostnames = set(name for account in self._accounts for host in account.hosts for name in host.namelist)
+        first_day, last_day = (start_ts - timedelta(days = days - 1)).strftime('%Y%m%d'), start_ts.strftime('%Y%m%d')
+        for fname in sorted(set(changed)):
+            hostname, day_file = os.path.basename(os.path.dirname(fname)), os.path.basename(fname)
+            ma = re.match(r'^day_([0-9]{8})(%s)?$' % re.escape(dayfile.SUFFIX), day_file)
+            if hostname not in hostnames or ma is None or not first_day <= ma.group(1) <= last_day: continue
+            job = self._file_job(os.path.join(self._data_path, hostname, day_file))
+            if job is not None:
+                yield hostname, ts2minute(datetime.strptime(ma.group(1), '%Y%m%d')), job
+
+    def load_data(self, start_ts: datetime, days: int, workers: int = 0,
+                  changed: Optional[Iterable[str]] = None) -> None:
+        """Load the day files of the days up to start_ts, only the paths in changed if given."""
+        if changed is None:
+            jobs = [job for n in range(0, -days, -1) for job in self._day_jobs(start_ts, n)]
+        else: jobs = list(self._changed_jobs(start_ts, days, changed))
+        parse_job = functools.partial(_parse_job, dayfile.router_names(self._data_path))
+        parsed: Iterable[ParsedFile]
+        executor: Optional[ProcessPoolExecutor] = None
+        if workers > 1 and len(jobs) > 1:
+            executor = ProcessPoolExecutor(workers)
+            parsed = executor.map(parse_job, [x[2] for x in jobs], chunksize = 16)
+        else: parsed = (parse_job(x[2]) for x in jobs)
+        last_minute = ts2minute(start_ts)
+        # rows of frozen months are not loaded again
+        first_minute = -1 if self.frozen_ts is None else ts2minute(self.frozen_ts)
+        c = self._conn.cursor()
+        loaded: List[int] = []
+        try:
+            for (hostname, day_minute, job), (rows, position, lines) in zip(jobs, parsed):
+                file_data = []
+                host_id = self._dimension_id('hosts', hostname)
+                late = False
+                for hour, minute, dat_in, dat_out, dat_pkg, router, dat_id in rows:
+                    row_minute = day_minute + hour * 60 + minute
+                    if row_minute > last_minute: late = True
+                    if row_minute > last_minute or row_minute < first_minute: continue
+                    file_data.append((host_id, row_minute, dat_in, dat_out, dat_pkg, dat_in + dat_out,
+                                      self._dimension_id('routers', router), _pack_dat_id(dat_id)))
+                c.executemany(self._load_sql, file_data)
+                # rows after start_ts are left for a later load, which reads the file again from the last position
+                # kept, the rows loaded now are ignored by their dat_id then
+                if not late: self._file_done(job, position, lines)
+                if len(file_data) > 0:
+                    loaded.append(min(x[1] for x in file_data))
+                    loaded.append(max(x[1] for x in file_data))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if len(loaded) > 0:
+            self._mark_dirty(min(loaded), max(loaded))
+            ingest_ts = self.get_state('ingest_ts')
+            if ingest_ts is None or int(ingest_ts) > min(loaded):
+                self.set_state('ingest_ts', str(min(loaded)))
+
+    def _mark_dirty(self, first: Optional[int], last: Optional[int]) -> None:
+        if first is None or last is None: return
+        if self._dirty is not None:
+            first, last = min(first, self._dirty[0]), max(last, self._dirty[1])
+        self._dirty = (first, last)
+
+    def _flush_rollups(self) -> None:
+        """Rebuild the rollup buckets touched since the last flush from the minute rows."""
+        if self._dirty is None: return
+        c = self._conn.cursor()
+        first, last = self._dirty[0] // 1440 * 1440, self._dirty[1] // 1440 * 1440 + 1439
+        # the nameless router of the router-less rows is '' in the rollups, their primary key cannot be NULL
+        for table, size in ROLLUPS:
+            c.execute('''DELETE FROM %s WHERE bucket BETWEEN ? AND ?''' % table, (first, last))
+            c.execute('''INSERT INTO %s(router, host, bucket, dat_in, dat_out, dat_pkg, dat)
+                         SELECT COALESCE(router, ''), host, ts / %d * %d, SUM(dat_in), SUM(dat_out), SUM(dat_pkg), SUM(dat)
+                         FROM data WHERE ts BETWEEN ? AND ? GROUP BY router, host, ts / %d''' \
+                      % (table, size, size, size), (first, last))
+        self._dirty = None
+
+    def reset_dat(self, start_ts: Optional[datetime] = None) -> None:
+        c = self._conn.cursor()
+        first = -1 if start_ts is None else ts2minute(start_ts)
+        self._mark_dirty(*c.execute('SELECT MIN(ts), MAX(ts) FROM data_minutes WHERE ts >= ? AND dat != dat_in + dat_out',
+                                    (first,)).fetchone())
+        c.execute('UPDATE data_minutes SET dat = dat_in + dat_out WHERE ts >= ? AND dat != dat_in + dat_out', (first,))
+
+    def clear_dat(self, router: str, start_ts: datetime, end_ts: datetime) -> None:
+        """Zero dat of every row of the router between start_ts and end_ts inclusive."""
         c = self._conn.cursor()
-        c.executemany(self._load_sql, one_day_data)
+        first, last = ts2minute(start_ts), ts2minute(end_ts)
+        c.execute('''UPDATE data_minutes SET dat = 0
+                     WHERE router_id IN (SELECT id FROM routers WHERE name = ?) AND ts BETWEEN ? AND ? AND dat != 0''',
+                  (router, first, last))
+        if c.rowcount > 0:
+            self._mark_dirty(first, last)
 
-    def load_data(self, start_ts: datetime, days: int) -> None:
-        for n in range(0, -days, -1):
-            self._load_one_day(start_ts, n)
+    def _query(self, kind: str, flt: Optional[str], sql_text: str, params: Tuple[Any, ...]) -> sqlite3.Cursor:
+        # the latest query of every kind and filter is kept for explain()
+        self._queries[(kind, flt)] = (sql_text, params)
+        return self._conn.cursor().execute(sql_text, params)
 
-    def reset_dat(self) -> None:
+    def explain(self) -> Dict[str, List[str]]:
+        """Query plans of the latest query of every kind and filter run so far, e.g. after the reports.
+        A full scan of the minute rows shows up as 'SCAN data_minutes'."""
         c = self._conn.cursor()
-        c.execute('UPDATE data SET dat = dat_in + dat_out')
+        result: Dict[str, List[str]] = {}
+        for (kind, flt), (sql_text, params) in self._queries.items():
+            result['%s: %s' % (kind, flt)] = [x[3] for x in c.execute('EXPLAIN QUERY PLAN %s' % sql_text, params)]
+        return result
 
     def commit(self) -> None:
+        self._flush_rollups()
         self._conn.commit()
 
-    def apply_mask(self, start_ts: datetime, cb: Callable[[DataRow], Optional[bool]],
-                   flt: Optional[str] = None, direction: str = 'future',
-                   args: Tuple[Any, ...] = tuple()) -> None:
-        c = self._conn.cursor()
+    def rollback(self) -> None:
+        """Drop the changes since the last commit, the rollups were flushed with it."""
+        self._dirty = None
+        self._conn.rollback()
+
+    def rows(self, start_ts: datetime, flt: Optional[str] = None,
+             direction: str = 'future') -> Generator[DataRow, None, None]:
         if direction not in ('future', 'past'):
             raise RuntimeError('Direction %s uknown' % repr(direction))
-        compare_sign = '>' if direction == 'future' else '<'
         sort_dir = 'ASC' if direction == 'future' else 'DESC'
-        the_filter = ts2filter(start_ts, compare_sign, flt)
-        the_order = 'year, month, day, hour, minute, router, host'
+        the_filter = 'ts BETWEEN ? AND ?'
+        if flt is not None:
+            the_filter = '%s AND (%s)' % (the_filter, flt)
+        the_order = 'ts %s, router %s, host %s' % (sort_dir, sort_dir, sort_dir)
         the_cols = ','.join(self._cols)
-        sql_text = '''SELECT id, %s FROM data WHERE %s ORDER BY %s %s''' % (the_cols, the_filter, the_order, sort_dir)
-        for row in c.execute(sql_text):
+        sql_text = '''SELECT id, %s FROM data WHERE %s ORDER BY %s''' % (the_cols, the_filter, the_order)
+        pieces = self._pieces(*((ts2minute(start_ts), 1 << 62) if direction == 'future' else (-1, ts2minute(start_ts))))
+        for first, last in pieces if direction == 'future' else reversed(pieces):
+            self._attach_shards((first, last))
+            yield from self._query('rows', flt, sql_text, (first, last))
+
+    def apply_mask(self, start_ts: datetime, cb: Callable[[DataRow], Optional[bool]],
+                   flt: Optional[str] = None, direction: str = 'future',
+                   args: Tuple[Any, ...] = tuple()) -> None:
+        for row in self.rows(start_ts, flt, direction):
             if cb(row, *args) == False:
                 break
 
-    def update_entries(self, column: str, changes: Iterable[Tuple[int, Union[str, int]]]) -> None:
+    def update_entries(self, column: str, changes: Iterable[Tuple[int, Union[str, int]]],
+                       chunk_size: int = 50000) -> None:
+        """Set column of the rows by id, staged chunk by chunk and applied with one joined UPDATE."""
+        if column not in self._cols:
+            raise RuntimeError('Column %s unknown' % repr(column))
         c = self._conn.cursor()
-        for idval, data in changes:
-            sql_text = 'UPDATE data SET %s = ? WHERE id = ?' % column
-            c.execute(sql_text, (data, idval))
+        c.execute('''DELETE FROM temp.entry_changes''')
+        staged: Iterable[Tuple[int, Any]] = changes
+        if column in ('host', 'router'):
+            table = '%ss' % column
+            staged = ((idval, self._dimension_id(table, cast(Optional[str], data))) for idval, data in changes)
+            column = '%s_id' % column
+        elif column == 'dat_id':
+            staged = ((idval, _pack_dat_id(cast(Optional[str], data))) for idval, data in changes)
+        staged = iter(staged)
+        while True:
+            chunk = list(itertools.islice(staged, chunk_size))
+            if len(chunk) == 0: break
+            c.executemany('''INSERT OR REPLACE INTO temp.entry_changes(id, value) VALUES (?,?)''', chunk)
+        dirty_sql = '''SELECT MIN(ts), MAX(ts) FROM data_minutes WHERE id IN (SELECT id FROM temp.entry_changes)'''
+        self._mark_dirty(*c.execute(dirty_sql).fetchone())
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            c.execute('''UPDATE data_minutes SET %s = entry_changes.value FROM temp.entry_changes
+                         WHERE data_minutes.id = entry_changes.id''' % column)
+        else:
+            c.execute('''UPDATE data_minutes SET %s = (SELECT value FROM temp.entry_changes WHERE entry_changes.id = data_minutes.id)
+                         WHERE id IN (SELECT id FROM temp.entry_changes)''' % column)
+        if column == 'ts':
+            self._mark_dirty(*c.execute(dirty_sql).fetchone())
+        c.execute('''DELETE FROM temp.entry_changes''')
 
     @property
     def rest_adds(self) -> Dict[str, int]:
@@ -186,17 +678,111 @@ class Storage(protocols.Storage):
         c.execute('''DELETE FROM rest_adds''')
         data = [(k,v) for k,v in rest_adds.items()]
         c.executemany('''INSERT INTO rest_adds(name, amount) VALUES (?,?)''', data)
+
+    def get_state(self, name: str) -> Optional[str]:
+        c = self._conn.cursor()
+        row = c.execute('''SELECT value FROM state WHERE name = ?''', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, name: str, value: Optional[str]) -> None:
+        c = self._conn.cursor()
+        if value is None: c.execute('''DELETE FROM state WHERE name = ?''', (name,))
+        else: c.execute('''INSERT OR REPLACE INTO state(name, value) VALUES (?,?)''', (name, value))
+
+    @property
+    def adds_applied(self) -> Dict[str, int]:
+        c = self._conn.cursor()
+        return dict(c.execute('''SELECT name, ts FROM adds_applied''').fetchall())
+
+    @adds_applied.setter
+    def adds_applied(self, adds_applied: Dict[str, int]) -> None:
+        c = self._conn.cursor()
+        c.execute('''DELETE FROM adds_applied''')
+        c.executemany('''INSERT INTO adds_applied(name, ts) VALUES (?,?)''', list(adds_applied.items()))
+
+    def adds_usage(self, end_ts: datetime) -> Dict[str, int]:
+        c = self._conn.cursor()
+        return dict(c.execute('''SELECT name, SUM(amount) FROM adds_usage WHERE ts < ? GROUP BY name''',
+                              (ts2minute(end_ts),)).fetchall())
+
+    def update_adds_usage(self, start_ts: Optional[datetime], usage: Iterable[Tuple[str, int, int]]) -> None:
+        """Replace the recorded adds consumption from start_ts on (everything when None) with usage."""
+        c = self._conn.cursor()
+        c.execute('''DELETE FROM adds_usage WHERE ts >= ?''', (-1 if start_ts is None else ts2minute(start_ts),))
+        c.executemany('''INSERT INTO adds_usage(name, ts, amount) VALUES (?,?,?)''', usage)
     
     def sum(self, start_ts: datetime, end_ts: datetime,
             flt: Optional[str] = None,
-            reference_column: str = 'host') -> Generator[protocols.Usage, None, None]:
-        c = self._conn.cursor()
-        the_filter = '%s AND %s' % (ts2filter(start_ts, sign = '<'), ts2filter(end_ts, sign = '>'))
+            reference_column: str = 'host',
+            args: Tuple[Any, ...] = tuple()) -> Generator[protocols.Usage, None, None]:
+        the_filter = 'ts BETWEEN ? AND ?'
         if flt is not None:
             the_filter = '%s AND %s' % (the_filter, flt)
         sql_text = 'SELECT %s, SUM(dat_in), SUM(dat_out), SUM(dat_pkg), SUM(dat) FROM data WHERE %s' \
             % (reference_column, the_filter)
-        c.execute(sql_text)
-        for row in c.fetchall():
+        rows: List[Tuple[Any, ...]] = []
+        pieces = self._pieces(ts2minute(end_ts), ts2minute(start_ts))
+        for first, last in pieces:
+            self._attach_shards((first, last))
+            rows.extend(self._query('sum', flt, sql_text, (first, last) + args).fetchall())
+        for row in rows if len(pieces) == 1 else _merge(rows, 1):
             yield protocols.Usage(*row)
         return None
+
+    def sum_windows(self, start_ts: datetime, end_tss: Sequence[datetime],
+                    flt: Optional[str] = None,
+                    reference_column: str = 'host',
+                    args: Tuple[Any, ...] = tuple()) -> Generator[Tuple[Optional[protocols.Usage], ...], None, None]:
+        """Sum every window from its end_ts up to start_ts in one scan of the widest one, grouped by reference_column.
+        A window without rows of the group gives None."""
+        the_filter = 'ts BETWEEN ? AND ?'
+        if flt is not None:
+            the_filter = '%s AND (%s)' % (the_filter, flt)
+        sums = ', '.join("SUM(CASE WHEN ts >= %d THEN %s ELSE 0 END)" % (ts2minute(end_ts), col)
+                         for end_ts in end_tss for col in ('dat_in', 'dat_out', 'dat_pkg', 'dat', '1'))
+        sql_text = 'SELECT %s, %s FROM data WHERE %s GROUP BY 1' % (reference_column, sums, the_filter)
+        rows: List[Tuple[Any, ...]] = []
+        pieces = self._pieces(min(ts2minute(x) for x in end_tss), ts2minute(start_ts))
+        for first, last in pieces:
+            self._attach_shards((first, last))
+            rows.extend(self._query('sum_windows', flt, sql_text, (first, last) + args).fetchall())
+        for row in rows if len(pieces) == 1 else _merge(rows, 1):
+            yield tuple(protocols.Usage(row[0], *row[n:n + 4]) if row[n + 4] > 0 else None
+                        for n in range(1, len(row), 5))
+        return None
+
+    def sum_periodic(self, start_ts: datetime, end_ts: datetime, period: str,
+                     flt: Optional[str] = None,
+                     reference_column: str = 'host',
+                     args: Tuple[Any, ...] = tuple()) -> Generator[Tuple[datetime, protocols.Usage], None, None]:
+        """Sum per period bucket between end_ts and start_ts, whole buckets come from the rollup tables."""
+        if period == 'hour': table, size, key = 'usage_hourly', 60, 'bucket'
+        elif period == 'day': table, size, key = 'usage_daily', 1440, 'bucket'
+        elif period == 'month': table, size, key = 'usage_daily', 1440, "strftime('%s', bucket * 60, 'unixepoch', 'start of month') / 60"
+        elif period == 'year': table, size, key = 'usage_daily', 1440, "strftime('%s', bucket * 60, 'unixepoch', 'start of year') / 60"
+        else: raise ValueError('Wrong period %s, need to be one of: year, month, day, hour.' % repr(period))
+        self._flush_rollups()
+        first, last = ts2minute(end_ts), ts2minute(start_ts)
+        # buckets in [full_first, full_last) lie completely inside the window, the edges come from the minute rows;
+        # the nameless router, '' in the rollups, has a branch of its own so a router filter still uses the key
+        full_first, full_last = -(-first // size) * size, (last + 1) // size * size
+        if full_last <= full_first: full_first = full_last = last + 1
+        the_cols = 'router, host, dat_in, dat_out, dat_pkg, dat'
+        sql_text = '''SELECT %s AS the_bucket, %s AS ref, SUM(dat_in), SUM(dat_out), SUM(dat_pkg), SUM(dat)
+                      FROM (SELECT bucket, %s FROM %s WHERE router > '' AND bucket >= ? AND bucket < ?
+                            UNION ALL
+                            SELECT bucket, NULL AS router, host, dat_in, dat_out, dat_pkg, dat
+                            FROM %s WHERE router = '' AND bucket >= ? AND bucket < ?
+                            UNION ALL
+                            SELECT ts / %d * %d AS bucket, %s FROM data WHERE ts BETWEEN ? AND ?
+                            UNION ALL
+                            SELECT ts / %d * %d AS bucket, %s FROM data WHERE ts BETWEEN ? AND ?) AS data
+                      WHERE %s GROUP BY the_bucket, ref ORDER BY the_bucket, ref''' \
+            % (key, reference_column, the_cols, table, table, size, size, the_cols, size, size, the_cols,
+               flt if flt is not None else '1')
+        self._attach_shards((first, full_first - 1), (full_last, last))
+        c = self._query('sum_periodic', flt, sql_text,
+                        (full_first, full_last, full_first, full_last, first, full_first - 1, full_last, last) + args)
+        for row in c.fetchall():
+            yield minute2ts(int(row[0])), protocols.Usage(*row[1:])
+        return None
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3.8
 
-import unittest, os, pickle
+import unittest, contextlib, io, os, pickle, socket, sqlite3, tempfile, shutil, threading, time, dayfile
 import protocols as p
 from limits import LimitSet
+from accounts import Account
+from hosts import Host
+from marks import Mark
 from storage import Storage
 from additionals import Additionals
 from reports import AccountsReport
+from filtering import Filtering
+from resolver import Resolver
+from usage_daemon import UsageDaemon
+from watch import DayFileWatch
+from dnscache import NameCache, reconcile
 from datetime import datetime as dt, timedelta as td
-from utils import bytes2units
-from typing import Dict, Tuple, List, Any
+from utils import bytes2units, minute2ts, ts2minute
+from typing import Dict, Tuple, List, Any, Optional
 
 class BasicTests(unittest.TestCase):
     _data_path: str
@@ -74,6 +82,351 @@ class BasicTests(unittest.TestCase):
                                         flt = "host = '%s'" % self.config['test_host'])
         self.assertEqual(len(res3), self.config['01_read_data_3'])
 
+    def test_06_migrate_schema(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, 'old.db')
+            conn = sqlite3.connect(db_file)
+            conn.execute('''CREATE TABLE data(id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT,
+                                              year INTEGER, month INTEGER, day INTEGER, hour INTEGER, minute INTEGER,
+                                              dat_in INTEGER, dat_out INTEGER, dat_pkg INTEGER,
+                                              dat INTEGER, router TEXT, dat_id TEXT)''')
+            conn.execute('''INSERT INTO data(host, year, month, day, hour, minute, dat_in, dat_out, dat_pkg, dat, router, dat_id)
+                            VALUES ('h', 2020, 3, 5, 7, 9, 10, 20, 1, 30, 'r', 'x'), (NULL, 2020, 3, 5, 7, 9, 1, 2, 1, 3, 'r', 'y')''')
+            conn.commit(); conn.close()
+            # a reader cannot migrate
+            with self.assertRaises(ValueError):
+                Storage(db_file, tuple(), tmpdir, False, 'report')
+            messages = io.StringIO()
+            with contextlib.redirect_stderr(messages):
+                stor = Storage(db_file, tuple(), tmpdir, True)
+            self.assertIn('drop 1 rows without a host', messages.getvalue())
+            rows = []; stor.apply_mask(dt(2020, 3, 5, 7, 9), lambda row: rows.append(row))
+            self.assertEqual(rows, [(1, 'h', ts2minute(dt(2020, 3, 5, 7, 9)), 10, 20, 1, 30, 'r', 'x')])
+            self.assertEqual(list(stor.sum(dt(2020, 3, 5, 7, 9), dt(2020, 3, 5, 7, 9))), [p.Usage('h', 10, 20, 1, 30)])
+
+    def test_07_reload_ignores_known_rows(self) -> None:
+        stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        stor.load_data(self.start_ts, 2)
+        count = stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+        stor._conn.execute('DELETE FROM files')
+        stor.load_data(self.start_ts, 2)
+        self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], count)
+
+    def test_08_tail_reading(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            day_file = os.path.join(tmpdir, 'hst', 'day_20200305')
+            account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(':memory:', (account,), tmpdir, True)
+            def count() -> Tuple[int, int]:
+                rows, dat = stor._conn.execute('SELECT COUNT(*), SUM(dat) FROM data').fetchone()
+                return rows, dat
+            with open(day_file, 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n1 1 10 10 1 rt\n1 2 10')
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            self.assertEqual(count(), (2, 40))
+            with open(day_file, 'a') as fd:
+                fd.write(' 10 1 rt\n1 3 10 10 1 rt\n')
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            self.assertEqual(count(), (4, 80))
+            with open(day_file, 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n1 1 10 10 1 rt\n1 2 10 10 1 rt\n1 3 10 10 1 rt\n1 4 10 10 1 rt\n')
+            os.utime(day_file, (1, 1))
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            self.assertEqual(count(), (5, 100))
+
+    def test_08_tail_reading_late_rows(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            with open(os.path.join(tmpdir, 'hst', 'day_20200305'), 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n1 1 10 10 1 rt\n5 0 10 10 1 rt\n')
+            account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(':memory:', (account,), tmpdir, True)
+            def count() -> int:
+                return int(stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0])
+            stor.load_data(dt(2020, 3, 5, 3, 0), 1)
+            self.assertEqual(count(), 2)
+            # the row after the first start_ts arrives with a later one
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            self.assertEqual(count(), 3)
+
+    def test_09_parallel_load(self) -> None:
+        stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        stor.load_data(self.start_ts, self.days + 1, workers = 3)
+        sql_text = 'SELECT * FROM data ORDER BY id'
+        self.assertEqual(stor._conn.execute(sql_text).fetchall(),
+                         self.stor._conn.execute(sql_text).fetchall())
+
+    def test_10_binary_day_file(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            host_path = os.path.join(tmpdir, self.config['test_host'])
+            shutil.copytree(os.path.join(self._data_path, self.config['test_host']), host_path)
+            day_file = os.path.join(host_path, 'day_%s' % self.start_ts.strftime('%Y%m%d'))
+            text_rows, _, _ = dayfile.parse_data_file(day_file)
+            self.assertEqual(dayfile.convert_file(day_file, tmpdir), len(text_rows))
+            self.assertFalse(os.path.exists(day_file))
+            bin_rows, position, records = dayfile.parse_binary_file(dayfile.binary_name(day_file),
+                                                                    dayfile.router_names(tmpdir))
+            self.assertEqual(bin_rows, text_rows)
+            self.assertEqual((position, records), (len(text_rows) * dayfile.RECORD.size, len(text_rows)))
+            # a file with an unfinished line is not converted, the line would be lost
+            torn_file = os.path.join(host_path, 'day_20200101')
+            with open(torn_file, 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n1 1 10')
+            self.assertEqual(dayfile.convert_file(torn_file, tmpdir), 0)
+            self.assertTrue(os.path.exists(torn_file))
+            self.assertFalse(os.path.exists(dayfile.binary_name(torn_file)))
+
+    def test_11_append_only_writers(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            day_file = os.path.join(tmpdir, 'day_20200305')
+            dayfile.append_line(day_file, dayfile.format_line(1, 2, 10, 20, 1, 'rt', '00' * 11))
+            with open(day_file, 'ab') as fd:
+                fd.write(b'12345678 1 3 10 20 1 rt 01')
+            dayfile.append_line(day_file, dayfile.format_line(1, 4, 10, 20, 1, 'rt', '02' * 11))
+            rows, _, lines = dayfile.parse_data_file(day_file)
+            self.assertEqual(rows, [(1, 2, 10, 20, 1, 'rt', '00' * 11), (1, 4, 10, 20, 1, 'rt', '02' * 11)])
+            self.assertEqual(lines, 3)
+            bin_file = dayfile.binary_name(day_file)
+            record = dayfile.pack_record(1, 2, 10, 20, 1, 0, b'\0' * 11)
+            dayfile.append_record(bin_file, record)
+            with open(bin_file, 'ab') as fd:
+                fd.write(record[:7])
+            dayfile.append_record(bin_file, record)
+            rows, position, records = dayfile.parse_binary_file(bin_file, ('rt',))
+            self.assertEqual(rows, [(1, 2, 10, 20, 1, 'rt', '00' * 11)] * 2)
+            self.assertEqual((position, records), (3 * dayfile.RECORD.size, 3))
+
+    def test_12_update_entries(self) -> None:
+        stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        stor.load_data(self.start_ts, 2)
+        ids = [x[0] for x in stor._conn.execute('SELECT id FROM data ORDER BY id').fetchall()]
+        stor.update_entries('dat', ((idval, idval * 2) for idval in ids), chunk_size = 7)
+        self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data WHERE dat != id * 2').fetchone()[0], 0)
+        with self.assertRaises(RuntimeError):
+            stor.update_entries('dat = 0; --', [(ids[0], 1)])
+
+    def test_13_dimension_ids(self) -> None:
+        stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        stor.load_data(self.start_ts, 1)
+        self.assertEqual(stor._conn.execute("SELECT COUNT(*) FROM data_minutes WHERE typeof(dat_id) != 'blob'").fetchone()[0], 0)
+        row = stor._conn.execute('SELECT id, host, router, dat_id FROM data ORDER BY id LIMIT 1').fetchone()
+        self.assertEqual(len(row[3]), 22)
+        self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data WHERE dat_id = ?', (row[3],)).fetchone()[0], 1)
+        stor.update_entries('host', [(row[0], 'otherhost')])
+        self.assertEqual(stor._conn.execute('SELECT host, router FROM data WHERE id = ?', (row[0],)).fetchone(),
+                         ('otherhost', row[2]))
+
+    def test_14_connection_profiles(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, 'data.db')
+            writer = Storage(db_file, tuple(self.accounts.values()), self._data_path, True, 'ingest')
+            writer.load_data(self.start_ts, 1)
+            writer.commit()
+            self.assertEqual(writer._conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            reader = Storage(db_file, tuple(self.accounts.values()), self._data_path, False, 'report')
+            count = reader._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+            writer.load_data(self.start_ts, 2)
+            # the open write transaction does not block the reader
+            self.assertEqual(reader._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], count)
+            writer.commit()
+            self.assertGreater(reader._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], count)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.reset_dat()
+            with self.assertRaises(ValueError):
+                Storage(db_file, tuple(), self._data_path, True, 'report')
+
+    def test_15_month_shards(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, 'data.db')
+            stor = Storage(db_file, tuple(self.accounts.values()), self._data_path, True)
+            stor.load_data(self.start_ts, self.days + 1)
+            Additionals(self._adds_path).apply_to_storage(stor)
+            stor.commit()
+            sums = sorted(stor.sum(self.start_ts, self.start_ts - td(days = 40), '1 GROUP BY host, router', 'host || router'))
+            count = stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+            frozen = list(stor.freeze_before(dt(2020, 3, 1)))
+            self.assertEqual([(year, month) for year, month, _ in frozen], [(2020, 2)])
+            self.assertEqual(frozen[0][2] + stor._conn.execute('SELECT COUNT(*) FROM data_minutes').fetchone()[0], count)
+            self.assertEqual(stor.frozen_ts, dt(2020, 3, 1))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'data.db.202002')))
+            self.assertEqual(sorted(stor.sum(self.start_ts, self.start_ts - td(days = 40), '1 GROUP BY host, router', 'host || router')), sums)
+            stor.load_data(self.start_ts, self.days + 1)
+            Additionals(self._adds_path).apply_to_storage(stor)
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], count)
+            with self.assertRaises(ValueError):
+                stor.freeze_month(2020, 2)
+
+    def test_15_month_shards_pieces(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            for month in range(1, 12):
+                with open(os.path.join(tmpdir, 'hst', 'day_2019%02d01' % month), 'w') as fd:
+                    fd.write('1 0 %d 0 1 rt\n' % month)
+            account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(os.path.join(tmpdir, 'data.db'), (account,), tmpdir, True)
+            stor.load_data(dt(2019, 12, 1), 340)
+            stor.commit()
+            ids = [x[0] for x in stor.rows(dt(2019, 1, 1))]
+            self.assertEqual(len(list(stor.freeze_before(dt(2019, 12, 1), hourly = True))), 11)
+            self.assertEqual([x[0] for x in stor.rows(dt(2019, 1, 1))], ids)
+            # eleven months are more than can be attached at once
+            self.assertEqual(list(stor.sum(dt(2019, 12, 1), dt(2019, 1, 1), 'router = ? GROUP BY host', args = ('rt',))),
+                             [p.Usage('hst', 66, 0, 11, 66)])
+            self.assertEqual([x[6] for x in stor.rows(dt(2019, 1, 1))], list(range(1, 12)))
+            self.assertEqual([x[6] for x in stor.rows(dt(2019, 12, 1), direction = 'past')], list(range(11, 0, -1)))
+            self.assertEqual(list(stor.sum_windows(dt(2019, 12, 1), (dt(2019, 11, 1), dt(2019, 1, 1)))),
+                             [(p.Usage('hst', 11, 0, 1, 11), p.Usage('hst', 66, 0, 11, 66))])
+            # attaching would commit the pending change
+            stor.reset_dat()
+            with self.assertRaises(RuntimeError):
+                list(stor.rows(dt(2019, 1, 1)))
+
+    def test_16_downsampling(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stor = Storage(os.path.join(tmpdir, 'data.db'), tuple(self.accounts.values()), self._data_path, True)
+            stor.load_data(self.start_ts, self.days + 1)
+            Additionals(self._adds_path).apply_to_storage(stor)
+            stor.commit()
+            stor.freeze_month(2020, 2)
+            end_ts, hourly_ts, daily_ts = dt(2020, 2, 20), self.start_ts - td(days = 5), self.start_ts - td(days = 10)
+            def report() -> Tuple[List[p.Usage], List[Tuple[dt, p.Usage]], List[Tuple[dt, p.Usage]]]:
+                return (sorted(stor.sum(self.start_ts, end_ts, '1 GROUP BY host, router', 'host || router')),
+                        list(stor.sum_periodic(self.start_ts, end_ts, 'day', None, 'router')),
+                        list(stor.sum_periodic(self.start_ts, hourly_ts, 'hour', None, 'router')))
+            before = report()
+            adds_usage = stor.adds_usage(self.start_ts)
+            count = len(list(stor.rows(end_ts)))
+            removed = stor.downsample(hourly_ts, daily_ts)
+            # the adds consumption before the frozen rows is kept as one row per name
+            self.assertEqual(stor.adds_usage(self.start_ts), adds_usage)
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) - COUNT(DISTINCT name) FROM adds_usage WHERE ts < ?',
+                                                (ts2minute(hourly_ts),)).fetchone()[0], 0)
+            self.assertEqual(len(list(stor.rows(end_ts))), count - removed)
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data WHERE ts < ? AND ts % 1440 != 0',
+                                                (ts2minute(dt(2020, 3, 5)),)).fetchone()[0], 0)
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data WHERE ts < ? AND ts % 60 != 0',
+                                                (ts2minute(hourly_ts),)).fetchone()[0], 0)
+            self.assertEqual(stor.frozen_ts, hourly_ts)
+            self.assertEqual(report(), before)
+            # the aggregates keep ids of their rows, so the ids in the shard and main stay apart
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) - COUNT(DISTINCT id) FROM data').fetchone()[0], 0)
+            stor.load_data(self.start_ts, self.days + 1)
+            Additionals(self._adds_path).apply_to_storage(stor)
+            stor.commit()
+            self.assertEqual(report(), before)
+            self.assertEqual(stor.downsample(hourly_ts, daily_ts), 0)
+
+    def test_17_usage_daemon(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+            # the html report needs the same limits on all accounts
+            limit_names = list(self.accounts.values())[0].limit.limit_names
+            accounts = tuple(acc for acc in self.accounts.values() if acc.limit.limit_names == limit_names)
+            outfile = os.path.join(tmpdir, 'usage.html')
+            daemon = UsageDaemon(stor, limit_names, accounts, self._data_path, self._adds_path,
+                                 self.days + 1, outputs = {self.config['test_router']: outfile}, interval = 3600)
+            daemon.cycle(self.start_ts)
+            self.assertEqual(stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], self.config['01_read_data_0'])
+            with open(outfile) as fd:
+                self.assertIn(self.config['test_router'], fd.read())
+            additionals = daemon.additionals()
+            daemon.wake(); daemon.wake()
+            def stopper() -> None:
+                while daemon.cycles < 2: time.sleep(0.01)
+                daemon.stop()
+            # the storage connection stays in this thread, the stopper only signals
+            thread = threading.Thread(target = stopper)
+            thread.start()
+            daemon.run()
+            thread.join()
+            self.assertEqual(daemon.cycles, 2)
+            self.assertIs(daemon.additionals(), additionals)
+
+    def test_18_changed_day_files(self) -> None:
+        for use_inotify in (True, False):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                os.makedirs(os.path.join(tmpdir, 'hst'))
+                day_file = os.path.join(tmpdir, 'hst', 'day_20200305')
+                account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+                stor = Storage(':memory:', (account,), tmpdir, True)
+                def count() -> int:
+                    return int(stor._conn.execute('SELECT COUNT(*) FROM data').fetchone()[0])
+                watch = DayFileWatch(tmpdir, ['hst'], use_inotify)
+                self.assertIsNone(watch.changed())
+                with open(day_file, 'w') as fd:
+                    fd.write('1 0 10 10 1 rt\n1 1 10 10 1 rt\n')
+                with open(os.path.join(tmpdir, 'hst', 'day_20200101'), 'w') as fd:
+                    fd.write('1 0 10 10 1 rt\n')
+                changed = watch.changed()
+                assert changed is not None
+                self.assertIn(day_file, changed)
+                stor.load_data(dt(2020, 3, 5, 23, 59), 2, changed = changed)
+                self.assertEqual(count(), 2)
+                with open(day_file, 'a') as fd:
+                    fd.write('1 2 10 10 1 rt\n')
+                os.utime(day_file, (time.time() + 1, time.time() + 1))
+                changed = watch.changed()
+                assert changed is not None
+                self.assertIn(day_file, changed)
+                stor.load_data(dt(2020, 3, 5, 23, 59), 2, changed = changed)
+                self.assertEqual(count(), 3)
+                # a cycle failing after changed() makes the next one scan all day files
+                with open(day_file, 'a') as fd:
+                    fd.write('1 3 10 10 1 rt\n')
+                stor.commit()
+                daemon = UsageDaemon(stor, ('1 day',), (account,), tmpdir, os.path.join(tmpdir, 'missing'), 2, watch = watch)
+                self.assertRaises(FileNotFoundError, daemon.cycle, dt(2020, 3, 5, 23, 59))
+                # and drops the rows it loaded
+                self.assertFalse(stor._conn.in_transaction)
+                self.assertEqual(count(), 3)
+                self.assertIsNone(watch.changed())
+                watch.close()
+
+    def test_19_dns_cache(self) -> None:
+        looked: List[str] = []
+        def lookup(ip: str) -> str:
+            looked.append(ip)
+            if ip == '10.10.1.3': raise socket.herror('unknown host')
+            if ip == '10.10.1.4': time.sleep(1)
+            return 'hst%s.kozachuk.info' % ip.split('.')[-1]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = NameCache(tmpdir, lookup = lookup)
+            names = cache.names(['10.10.1.2', '10.10.1.3', '10.10.1.4'], deadline = 0.3)
+            self.assertEqual(names, {'10.10.1.2': 'hst2.kozachuk.info', '10.10.1.3': '10.10.1.3', '10.10.1.4': '10.10.1.4'})
+            cache.save()
+            looked.clear()
+            # the name and the failed lookup are both kept, only the unfinished one is looked up again
+            cache = NameCache(tmpdir, lookup = lookup)
+            self.assertEqual(cache.names(['10.10.1.2', '10.10.1.3'], deadline = 0.3),
+                             {'10.10.1.2': 'hst2.kozachuk.info', '10.10.1.3': '10.10.1.3'})
+            self.assertEqual(looked, [])
+            os.makedirs(os.path.join(tmpdir, '10.10.1.2'))
+            os.makedirs(os.path.join(tmpdir, 'hst2'))
+            with open(os.path.join(tmpdir, '10.10.1.2', 'day_20200305'), 'w') as fd:
+                fd.write('1 1 10 10 1 rt\n1 2 10')
+            with open(os.path.join(tmpdir, 'hst2', 'day_20200305'), 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n')
+            self.assertEqual(reconcile(tmpdir, cache), [('10.10.1.2', 'hst2')])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, '10.10.1.2')))
+            # the unfinished line is kept, the next append closes it
+            dayfile.append_line(os.path.join(tmpdir, 'hst2', 'day_20200305'), b'1 3 10 10 1 rt\n')
+            with open(os.path.join(tmpdir, 'hst2', 'day_20200305')) as fd:
+                self.assertEqual(fd.read(), '1 0 10 10 1 rt\n1 1 10 10 1 rt\n1 2 10\n1 3 10 10 1 rt\n')
+            # files left by a crash before the append go along, emptied ones after it are only removed
+            os.makedirs(os.path.join(tmpdir, '10.10.1.2'))
+            with open(os.path.join(tmpdir, '10.10.1.2', 'day_20200305.4242.tmp'), 'w') as fd:
+                fd.write('1 4 10 10 1 rt\n')
+            with open(os.path.join(tmpdir, '10.10.1.2', 'day_20200306.4242.tmp'), 'w') as fd:
+                pass
+            with open(os.path.join(tmpdir, '10.10.1.2', 'day_20200305'), 'w') as fd:
+                fd.write('1 5 10 10 1 rt\n')
+            self.assertEqual(reconcile(tmpdir, cache), [('10.10.1.2', 'hst2')])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, '10.10.1.2')))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'hst2', 'day_20200306')))
+            with open(os.path.join(tmpdir, 'hst2', 'day_20200305')) as fd:
+                self.assertEqual(fd.read().splitlines()[-2:], ['1 4 10 10 1 rt', '1 5 10 10 1 rt'])
+
     def test_20_additionals_read(self) -> None:
         self.assertEqual(tuple(sorted(self.adds.routers)), tuple(sorted(self.routers)))
         self.assertEqual(len(list(self.adds[self.config['test_router']])),
@@ -118,12 +471,66 @@ class BasicTests(unittest.TestCase):
             for adds in self.adds[adds_name]:
                 if adds not in self.config['adds_rows']: continue
                 for ra, rb in zip(sorted(self.config['adds_rows'][adds]),
-                                  sorted(map(lambda r: (dt(r[2], r[3], r[4], r[5], r[6]), r[11], r[1], r[10]),
+                                  sorted(map(lambda r: (minute2ts(r[2]), r[7], r[1], r[6]),
                                              collect_rows[adds]))):
                     print("%s == %s" % (repr(ra), repr(rb)))
                     self.assertEqual(ra, rb)
         self.assertEqual(self.config['dat_with_adds'], datsum_after)
 
+    def test_51_incremental_additionals(self) -> None:
+        full = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        full.load_data(self.start_ts, self.days + 1)
+        Additionals(self._adds_path).apply_to_storage(full)
+        stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+        stor.load_data(self.start_ts - td(days = 4), self.days - 3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            adds_path = os.path.join(tmpdir, 'additional_contingent.dat')
+            with open(self._adds_path) as fd:
+                adds_lines = fd.readlines()
+            with open(adds_path, 'w') as fd:
+                fd.writelines(adds_lines[::2])
+            Additionals(adds_path).apply_to_storage(stor)
+            with open(adds_path, 'w') as fd:
+                fd.writelines(adds_lines)
+            Additionals(adds_path).apply_to_storage(stor)
+        stor.load_data(self.start_ts, self.days + 1)
+        Additionals(self._adds_path).apply_to_storage(stor)
+        self.assertIsNone(stor.get_state('ingest_ts'))
+        sql_text = 'SELECT dat_id, dat FROM data ORDER BY dat_id'
+        self.assertEqual(stor._conn.execute(sql_text).fetchall(), full._conn.execute(sql_text).fetchall())
+        self.assertEqual(stor.rest_adds, full.rest_adds)
+
+    def test_52_boosts_set_based(self) -> None:
+        result = []
+        collect_rows: Optional[Dict[p.AddsEntry, List[p.DataRow]]]
+        for collect_rows in ({}, None):
+            stor = Storage(':memory:', tuple(self.accounts.values()), self._data_path, True)
+            stor.load_data(self.start_ts, self.days + 1)
+            Additionals(self._adds_path).apply_to_storage(stor, collect_rows)
+            result.append((stor._conn.execute('SELECT dat_id, dat FROM data ORDER BY dat_id').fetchall(), stor.rest_adds))
+        self.assertEqual(result[0], result[1])
+
+    def test_53_identical_adds(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            day_file = os.path.join(tmpdir, 'hst', 'day_20200305')
+            with open(day_file, 'w') as fd:
+                fd.write('1 0 1000 1000 1 rt\n')
+            adds_path = os.path.join(tmpdir, 'additional_contingent.dat')
+            with open(adds_path, 'w') as fd:
+                fd.write('2020-03-05 00:00 data rt hst 1 KiB\n' * 2)
+            account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(':memory:', (account,), tmpdir, True)
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            Additionals(adds_path).apply_to_storage(stor)
+            self.assertEqual(stor.rest_adds, {'hst': 48})
+            with open(day_file, 'a') as fd:
+                fd.write('1 1 10 10 1 rt\n')
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            Additionals(adds_path).apply_to_storage(stor)
+            self.assertEqual(stor.rest_adds, {'hst': 28})
+            self.assertEqual(stor._conn.execute('SELECT SUM(dat) FROM data').fetchone()[0], 0)
+
     def test_60_reports(self) -> None:
         if not self.adds_applied:
             self.adds.apply_to_storage(self.stor)
@@ -160,5 +567,214 @@ class BasicTests(unittest.TestCase):
             for acc, usage in sorted(result.items(), key = lambda x: x[0].name):
                 print(acc.name, bytes2units(usage.dat), acc.limit.limit(limit).amount_text)
 
+    def test_62_rollups(self) -> None:
+        if not self.adds_applied:
+            self.adds.apply_to_storage(self.stor)
+            self.adds_applied = True
+        self.stor.commit()
+        for table, size in (('usage_hourly', 60), ('usage_daily', 1440)):
+            rollup = self.stor._conn.execute('SELECT router, host, bucket, dat_in, dat_out, dat_pkg, dat FROM %s '
+                                             'ORDER BY router, host, bucket' % table).fetchall()
+            direct = self.stor._conn.execute('SELECT router, host, ts / %d * %d AS b, SUM(dat_in), SUM(dat_out), '
+                                             'SUM(dat_pkg), SUM(dat) FROM data GROUP BY router, host, b '
+                                             'ORDER BY router, host, b' % (size, size)).fetchall()
+            self.assertEqual(rollup, direct)
+
+    def test_63_usage_single_pass(self) -> None:
+        if not self.adds_applied:
+            self.adds.apply_to_storage(self.stor)
+            self.adds_applied = True
+        limit_names = tuple(sorted(set(x for acc in self.accounts.values() for x in acc.limit.limit_names)))
+        reports = AccountsReport(limit_names, tuple(self.accounts.values()), self.stor)
+        for start_ts in (self.start_ts, self.start_ts - td(days = 2, minutes = 7)):
+            account_usage, host_usage = reports.usage(start_ts, self.config['test_router'])
+            for limit in limit_names:
+                self.assertEqual(account_usage[limit], reports.account_usage(start_ts, self.config['test_router'], limit))
+                self.assertEqual(host_usage[limit], reports.host_usage(start_ts, self.config['test_router'], limit))
+
+    def test_64_host_account_table(self) -> None:
+        mapping = dict(self.stor._conn.execute('SELECT host, account FROM temp.host_account').fetchall())
+        self.assertEqual(mapping, {host.name: acc.short for acc in self.accounts.values() for host in acc.hosts})
+
+    def test_65_report_query_plans(self) -> None:
+        limit_names = tuple(sorted(set(x for acc in self.accounts.values() for x in acc.limit.limit_names)))
+        reports = AccountsReport(limit_names, tuple(self.accounts.values()), self.stor)
+        reports.usage(self.start_ts, self.config['test_router'])
+        reports.account_usage(self.start_ts, self.config['test_router'], limit_names[0])
+        reports.host_usage(self.start_ts, self.config['test_router'], limit_names[0])
+        reports.account_usage_periodic(self.start_ts, self.config['test_router'], 5, period = 'hour')
+        plans = self.stor.explain()
+        self.assertTrue({'sum', 'sum_windows', 'sum_periodic'} <= set(x.split(':')[0] for x in plans))
+        for query, plan in plans.items():
+            self.assertFalse(any(x.startswith('SCAN data_minutes') for x in plan), (query, plan))
+
+    def test_66_rollups_without_router(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            with open(os.path.join(tmpdir, 'hst', 'day_20200305'), 'w') as fd:
+                fd.write('1 0 10 10 1\n1 1 10 10 1\n1 2 10 10 1 rt\n')
+            account = Account('ac', 'account', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(':memory:', (account,), tmpdir, True)
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            stor.commit()
+            self.assertEqual(list(stor.sum_periodic(dt(2020, 3, 5, 23, 59), dt(2020, 3, 5), 'hour', None, 'router')),
+                             [(dt(2020, 3, 5, 1), p.Usage(None, 20, 20, 2, 40)),
+                              (dt(2020, 3, 5, 1), p.Usage('rt', 10, 10, 1, 20))])
+
+    def test_67_host_of_two_accounts(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'hst'))
+            with open(os.path.join(tmpdir, 'hst', 'day_20200305'), 'w') as fd:
+                fd.write('1 0 10 10 1 rt\n')
+            monthly = Account('mo', 'monthly', (Host('hst'),), LimitSet(('30 days',)), Mark.M1MBIT)
+            daily = Account('da', 'daily', (Host('hst'),), LimitSet(('1 day',)), Mark.M1MBIT)
+            stor = Storage(':memory:', (monthly, daily), tmpdir, True)
+            stor.load_data(dt(2020, 3, 5, 23, 59), 1)
+            reports = AccountsReport(('1 day', '30 days'), (monthly, daily), stor)
+            self.assertEqual(reports.account_usage(dt(2020, 3, 5, 23, 59), 'rt', '1 day'), {daily: p.Usage('da', 10, 10, 1, 20)})
+            self.assertEqual(reports.usage(dt(2020, 3, 5, 23, 59), 'rt')[0]['1 day'], {daily: p.Usage('da', 10, 10, 1, 20)})
+
+    def test_70_firewall_restore(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hosts = (Host('hst'), Host('oth', ('10.0.0.2',)))
+            account = Account('ac', 'account', hosts, LimitSet(('1 day',)).set('1 day', 1000), Mark.M256KBIT)
+            commands: List[str] = []
+            def cmd(command: str) -> int:
+                commands.append(command)
+                if command.startswith('/sbin/iptables-save'):
+                    with open(os.path.join(tmpdir, 'iptables.save'), 'w') as fd:
+                        fd.write('*mangle\n:FORWARD ACCEPT [0:0]\n'
+                                 '-A FORWARD -s 10.0.0.2/32 -m comment --comment usage:oth:10.0.0.2:src:mark3 -j MARK --set-xmark 0x3/0xffffffff\n'
+                                 '-A FORWARD -s 10.0.0.1/32 -m comment --comment usage:hst:10.0.0.1:src:mark1 -j MARK --set-xmark 0x1/0xffffffff\n'
+                                 '-A FORWARD -s 10.0.0.9/32 -j MARK --set-xmark 0x1/0xffffffff\n'
+                                 '-A FORWARD -d 10.0.0.2/32 -j MARK --set-xmark 0x3/0xffffffff\n'
+                                 'COMMIT\n*filter\n:FORWARD ACCEPT [0:0]\n'
+                                 '-A FORWARD -s 10.0.0.1/32 -j REJECT --reject-with icmp-port-unreachable\n'
+                                 'COMMIT\n')
+                return 0
+            def unknown(name: str) -> str:
+                raise socket.gaierror('unknown')
+            # hst does not resolve and keeps the address of its rules
+            Filtering(('1 day',), (account,), {'1 day': {account: p.Usage('ac', dat = 1300)}},
+                      Resolver(hosts, None, lookup = unknown)).restore(tmpdir, {'oth': 10}, cmd)
+            self.assertEqual(len(commands), 2)
+            with open(os.path.join(tmpdir, 'iptables.restore')) as fd:
+                self.assertEqual(fd.read().splitlines(), [
+                    '*mangle',
+                    '-D FORWARD -d 10.0.0.2/32 -j MARK --set-xmark 0x3/0xffffffff',
+                    '-D FORWARD -s 10.0.0.1/32 -m comment --comment usage:hst:10.0.0.1:src:mark1 -j MARK --set-xmark 0x1/0xffffffff',
+                    '-D FORWARD -s 10.0.0.2/32 -m comment --comment usage:oth:10.0.0.2:src:mark3 -j MARK --set-xmark 0x3/0xffffffff',
+                    '-I FORWARD -d 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:dst:mark3 -j MARK --set-mark 3',
+                    '-I FORWARD -s 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:src:mark3 -j MARK --set-mark 3',
+                    '-A FORWARD -j CONNMARK --save-mark',
+                    'COMMIT',
+                    '*filter',
+                    '-D FORWARD -s 10.0.0.1/32 -j REJECT --reject-with icmp-port-unreachable',
+                    '-I FORWARD -d 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:dst:reject -j REJECT',
+                    '-I FORWARD -s 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:src:reject -j REJECT',
+                    'COMMIT'])
+
+    def test_71_firewall_nftables(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            limits = LimitSet(('1 day',)).set('1 day', 1000)
+            over = Account('ac', 'account', (Host('hst', ('10.0.0.1',)), Host('oth', ('10.0.0.2',))), limits, Mark.M256KBIT)
+            soft = Account('sa', 'soft', (Host('sft', ('10.0.0.3',)),), limits, Mark.M64KBIT, no_hardlimit = True)
+            under = Account('un', 'under', (Host('und', ('10.0.0.4',)),), limits, Mark.M1MBIT)
+            usage: Dict[str, Dict[p.Account, p.Usage]] = \
+                {'1 day': {over: p.Usage('ac', dat = 1300), soft: p.Usage('sa', dat = 1300), under: p.Usage('un', dat = 10)}}
+            commands: List[str] = []
+            Filtering(('1 day',), (over, soft, under), usage, Resolver(over.hosts + soft.hosts + under.hosts, None)) \
+                .nftables(tmpdir, {'oth': 10}, commands.append)
+            self.assertEqual(commands, ['/usr/sbin/nft -f %s/nftables.rules' % tmpdir])
+            with open(os.path.join(tmpdir, 'nftables.rules')) as fd:
+                rules = fd.read().splitlines()
+            self.assertIn('add element ip usage marks { 10.0.0.1 : 3, 10.0.0.3 : 5 }', rules)
+            self.assertIn('add element ip usage rejects { 10.0.0.1 }', rules)
+            self.assertIn('add rule ip usage forward meta mark set ip saddr map @marks', rules)
+            self.assertLess(rules.index('flush set ip usage rejects'), rules.index('add element ip usage rejects { 10.0.0.1 }'))
+
+    def test_72_firewall_state(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            limits = LimitSet(('1 day',)).set('1 day', 1000)
+            account = Account('ac', 'account', (Host('hst', ('10.0.0.1',)),), limits, Mark.M256KBIT)
+            other = Account('ot', 'other', (Host('oth', ('10.0.0.2',)),), limits, Mark.M1MBIT)
+            commands: List[str] = []
+            def cmd(command: str) -> int:
+                commands.append(command)
+                if command.startswith('/sbin/iptables-save'):
+                    with open(os.path.join(tmpdir, 'iptables.save'), 'w') as fd:
+                        fd.write('*mangle\n:FORWARD ACCEPT [0:0]\nCOMMIT\n*filter\n:FORWARD ACCEPT [0:0]\nCOMMIT\n')
+                return 0
+            def filtering(dat: int) -> Filtering:
+                return Filtering(('1 day',), (account, other),
+                                 {'1 day': {account: p.Usage('ac', dat = dat), other: p.Usage('ot', dat = 10)}},
+                                 Resolver(account.hosts + other.hosts, None))
+            self.assertEqual(filtering(1100).apply(tmpdir, None, 'iptables', cmd), ['hst: ? -> 10.0.0.1 mark 3'])
+            self.assertEqual(len(commands), 2)
+            del commands[:]
+            self.assertEqual(filtering(1100).apply(tmpdir, None, 'iptables', cmd), [])
+            self.assertEqual(commands, [])
+            transition = ['hst: 10.0.0.1 mark 3 -> 10.0.0.1 mark 3, reject']
+            self.assertEqual(filtering(1300).apply(tmpdir, None, 'iptables', cmd, dry_run = True), transition)
+            self.assertEqual(commands, [])
+            self.assertEqual(filtering(1300).apply(tmpdir, None, 'iptables', cmd), transition)
+            self.assertEqual(commands, ['/sbin/iptables-restore --noflush <%s/iptables.restore' % tmpdir])
+            with open(os.path.join(tmpdir, 'iptables.restore')) as fd:
+                self.assertEqual(fd.read().splitlines(), [
+                    '*filter',
+                    '-I FORWARD -d 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:dst:reject -j REJECT',
+                    '-I FORWARD -s 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:src:reject -j REJECT',
+                    'COMMIT'])
+            # a changed address replaces the rules of the old one
+            moved = Account('ac', 'account', (Host('hst', ('10.0.0.5',)),), limits, Mark.M256KBIT)
+            self.assertEqual(Filtering(('1 day',), (moved, other), {'1 day': {moved: p.Usage('ac', dat = 1300)}},
+                                       Resolver(moved.hosts, None)).apply(tmpdir, None, 'iptables', cmd),
+                             ['hst: 10.0.0.1 mark 3, reject -> 10.0.0.5 mark 3, reject'])
+            with open(os.path.join(tmpdir, 'iptables.restore')) as fd:
+                rules = fd.read().splitlines()
+            self.assertIn('-D FORWARD -s 10.0.0.1 -m comment --comment usage:hst:10.0.0.1:src:reject -j REJECT', rules)
+            self.assertIn('-I FORWARD -s 10.0.0.5 -m comment --comment usage:hst:10.0.0.5:src:reject -j REJECT', rules)
+            # another backend starts without a state
+            self.assertEqual(filtering(1300).apply(tmpdir, None, 'nftables', cmd), ['hst: ? -> 10.0.0.1 mark 3, reject'])
+            # a failing full apply keeps no state, so the next run applies everything again
+            def failing(command: str) -> int:
+                return cmd(command) if command.startswith('/sbin/iptables-save') else 4
+            self.assertEqual(filtering(1100).apply(tmpdir, None, 'iptables', failing),
+                             ['hst: ? -> 10.0.0.1 mark 3', 'iptables: failed with status 4, the state is dropped'])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'firewall.state')))
+
+    def test_73_resolver(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hosts_file = os.path.join(tmpdir, 'hosts')
+            with open(hosts_file, 'w') as fd:
+                fd.write('127.0.0.1 localhost\n10.0.0.2 oth.kozachuk.info oth # comment\n')
+            lookups: List[str] = []
+            def lookup(name: str) -> str:
+                lookups.append(name)
+                if name == 'bad.kozachuk.info': raise socket.gaierror('unknown')
+                return '10.0.0.3'
+            hosts = (Host('hst', ('10.0.0.1',)), Host('oth'), Host('new'), Host('bad'))
+            resolver = Resolver(hosts, hosts_file, lookup = lookup)
+            expected = {'hst': '10.0.0.1', 'oth': '10.0.0.2', 'new': '10.0.0.3'}
+            self.assertEqual(resolver.addresses(x.name for x in hosts), expected)
+            self.assertEqual(resolver.addresses(x.name for x in hosts), expected)
+            self.assertEqual(sorted(lookups), ['bad.kozachuk.info', 'bad.kozachuk.info', 'new.kozachuk.info'])
+            account = Account('ac', 'account', hosts, LimitSet(('1 day',)).set('1 day', 1000), Mark.M256KBIT)
+            commands: List[str] = []
+            Filtering(('1 day',), (account,), {'1 day': {account: p.Usage('ac', dat = 1100)}},
+                      resolver).nftables(tmpdir, None, commands.append)
+            with open(os.path.join(tmpdir, 'nftables.rules')) as fd:
+                self.assertIn('add element ip usage marks { 10.0.0.1 : 3, 10.0.0.2 : 3, 10.0.0.3 : 3 }', fd.read().splitlines())
+            self.assertIn('bad: no address, left out', Filtering(('1 day',), (account,), {'1 day': {account: p.Usage('ac', dat = 1100)}},
+                                                                 resolver).apply(tmpdir, None, 'iptables', commands.append, dry_run = True))
+            # a hanging lookup is given up at the timeout and left in a daemon thread
+            release = threading.Event()
+            def hanging(name: str) -> str:
+                release.wait()
+                return '10.0.0.4'
+            self.assertEqual(Resolver((Host('slw'),), None, timeout = 0.1, lookup = hanging).addresses(['slw']), {})
+            self.assertTrue(all(x.daemon for x in threading.enumerate() if x is not threading.main_thread()))
+            release.set()
+
 if __name__ == '__main__':
     unittest.main()
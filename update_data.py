@@ -9,8 +9,8 @@ from data_config import addsfile, accounts
 timing = time.monotonic()
 def t() -> str: return "%ds" % int(time.monotonic() - timing)
 
-if len(sys.argv) != 5:
-    sys.stderr.write('Usage: %s <start_ts> <days> <directory> <dbfile>\n' % sys.argv[0])
+if len(sys.argv) not in (5, 6):
+    sys.stderr.write('Usage: %s <start_ts> <days> <directory> <dbfile> [<workers>]\n' % sys.argv[0])
     sys.exit(1)
 
 if sys.argv[1].lower() == 'now':
@@ -19,13 +19,14 @@ else: start_ts = dt.strptime(sys.argv[1], "%Y-%m-%d %H:%M")
 days = int(sys.argv[2])
 directory = sys.argv[3]
 db_file = sys.argv[4]
+workers = int(sys.argv[5]) if len(sys.argv) > 5 else 0
 pid = os.getpid()
 
 print(pid, t(), 'load data from file %s' % repr(db_file), flush = True)
-storage = Storage(db_file, accounts, directory, True)
+storage = Storage(db_file, accounts, directory, True, 'ingest')
 
 print(pid, t(), 'load data from directory %s' % repr(directory), flush = True)
-storage.load_data(start_ts, days)
+storage.load_data(start_ts, days, workers)
 
 print(pid, t(), 'load additionals from file %s' % repr(addsfile(directory)), flush = True)
 additionals = Additionals(addsfile(directory))
@@ -1,19 +1,18 @@
 #!/usr/bin/env python3.8
 
 import sys, time, os
-import protocols as p
 from storage import Storage
 from filtering import Filtering
+from resolver import Resolver
 from reports import AccountsReport
 from datetime import datetime as dt
 from data_config import accounts, lnames
-from typing import Dict
 
 timing = time.monotonic()
 def t() -> str: return "%ds" % int(time.monotonic() - timing)
 
-if len(sys.argv) != 6:
-    sys.stderr.write('Usage: %s <start_ts> <days> <router> <directory> <dbfile>\n' % sys.argv[0])
+if len(sys.argv) not in (6, 7, 8) or not set(sys.argv[6:]) <= {'iptables', 'nftables', 'dry-run'}:
+    sys.stderr.write('Usage: %s <start_ts> <days> <router> <directory> <dbfile> [iptables|nftables] [dry-run]\n' % sys.argv[0])
     sys.exit(1)
 
 if sys.argv[1].lower() == 'now':
@@ -23,19 +22,20 @@ days = int(sys.argv[2])
 router = sys.argv[3]
 directory = sys.argv[4]
 db_file = sys.argv[5]
+backend = 'nftables' if 'nftables' in sys.argv[6:] else 'iptables'
+dry_run = 'dry-run' in sys.argv[6:]
 pid = os.getpid()
 
 print(pid, t(), router, 'load data from file %s' % repr(db_file), flush = True)
-storage = Storage(db_file, accounts, directory, False)
+storage = Storage(db_file, accounts, directory, False, 'report')
 
 reports = AccountsReport(lnames, accounts, storage)
 print(pid, t(), router, 'calculate account usage', flush = True)
-account_usage: Dict[str, Dict[p.Account, p.Usage]] = {}
-for limit_name in lnames:
-    account_usage[limit_name] = reports.account_usage(start_ts, router, limit_name)
+account_usage, _ = reports.usage(start_ts, router)
 
-print(pid, t(), router, 'configure firewall', flush = True)
-filtering = Filtering(lnames, accounts, account_usage)
-filtering.filter(directory, storage.rest_adds)
+print(pid, t(), router, 'plan firewall' if dry_run else 'configure firewall', flush = True)
+filtering = Filtering(lnames, accounts, account_usage, Resolver([host for account in accounts for host in account.hosts]))
+for transition in filtering.apply(directory, storage.rest_adds, backend, dry_run = dry_run):
+    print(pid, t(), router, transition, flush = True)
 
-print(pid, t(), router, 'firewall configured.')
+print(pid, t(), router, 'firewall planned.' if dry_run else 'firewall configured.')
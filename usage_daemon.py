@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.8
+
+import sys, time, os, signal, threading, traceback
+import protocols as p
+from additionals import Additionals
+from filtering import Filtering, BACKENDS
+from resolver import Resolver
+from watch import DayFileWatch
+from reports import AccountsReport, HtmlReport
+from datetime import datetime as dt
+from typing import Tuple, Dict, Optional
+
+class UsageDaemon(object):
+    """Runs ingest, adds, firewall and html reports as one cycle on a schedule, keeping the storage,
+    the additionals and the accounts in memory between the cycles."""
+    def __init__(self,
+                 storage: p.Storage,
+                 limit_names: Tuple[str, ...],
+                 accounts: Tuple[p.Account, ...],
+                 directory: str,
+                 adds_path: str,
+                 days: int,
+                 firewall_router: Optional[str] = None,
+                 outputs: Optional[Dict[str, str]] = None,
+                 header: str = '',
+                 footer: str = '',
+                 interval: float = 60,
+                 workers: int = 0,
+                 watch: Optional[DayFileWatch] = None,
+                 firewall_backend: str = 'iptables') -> None:
+        self._storage = storage
+        self._limit_names = limit_names
+        self._accounts = accounts
+        self._directory = directory
+        self._adds_path = adds_path
+        self._days = days
+        self._firewall_router = firewall_router
+        self._outputs = {} if outputs is None else outputs
+        self._header, self._footer = header, footer
+        self._interval = interval
+        self._workers = workers
+        self._watch = watch
+        if firewall_backend not in BACKENDS:
+            raise ValueError('Firewall backend %s unknown, need to be one of: %s.' % (repr(firewall_backend), ', '.join(BACKENDS)))
+        self._firewall_backend = firewall_backend
+        self._resolver = Resolver([host for account in accounts for host in account.hosts])
+        self._additionals: Optional[Additionals] = None
+        self._adds_mtime: Optional[float] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.cycles = 0
+
+    def wake(self) -> None:
+        """Request a cycle now, requests arriving before it starts or while one runs are coalesced into one."""
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def additionals(self) -> Additionals:
+        """The parsed additionals file, parsed again only after it changed."""
+        mtime = os.stat(self._adds_path).st_mtime
+        if self._additionals is None or mtime != self._adds_mtime:
+            self._additionals, self._adds_mtime = Additionals(self._adds_path), mtime
+        return self._additionals
+
+    def cycle(self, start_ts: Optional[dt] = None) -> None:
+        if start_ts is None: start_ts = dt.now()
+        changed = None if self._watch is None else self._watch.changed()
+        try:
+            self._storage.load_data(start_ts, self._days, self._workers, changed)
+            self.additionals().apply_to_storage(self._storage)
+            self._storage.commit()
+        except Exception:
+            # the rows loaded and adds applied so far go, the changed paths are consumed by now,
+            # so the next cycle scans all day files instead
+            self._storage.rollback()
+            if self._watch is not None: self._watch.rescan()
+            raise
+        reports = AccountsReport(self._limit_names, self._accounts, self._storage)
+        rest_adds = self._storage.rest_adds
+        if self._firewall_router is not None:
+            account_usage, _ = reports.usage(start_ts, self._firewall_router)
+            filtering = Filtering(self._limit_names, self._accounts, account_usage, self._resolver)
+            for transition in filtering.apply(self._directory, rest_adds, self._firewall_backend):
+                print(os.getpid(), self._firewall_router, transition, flush = True)
+        for router, outfile in self._outputs.items():
+            account_usage, host_usage = reports.usage(start_ts, router)
+            account_usage_daily = reports.account_usage_periodic(start_ts, router, self._days, period = 'day')
+            account_usage_hourly = reports.account_usage_periodic(start_ts, router, 31, period = 'hour')
+            with open(outfile + ".tmp", 'w') as fd:
+                html_report = HtmlReport(router, self._limit_names, self._accounts, account_usage, host_usage,
+                                         account_usage_daily, account_usage_hourly, rest_adds,
+                                         self._header, self._footer, fd)
+                html_report()
+            os.rename(outfile + ".tmp", outfile)
+        self.cycles += 1
+
+    def run(self) -> None:
+        """Run a cycle at every interval and on wake() until stop(). Ticks missed by a long cycle are coalesced
+        into one cycle right after it, a failing cycle is logged and the next one tried."""
+        pid = os.getpid()
+        next_tick = time.monotonic()
+        while True:
+            self._wake.wait(max(0.0, next_tick - time.monotonic()))
+            if self._stop.is_set(): break
+            self._wake.clear()
+            started = time.monotonic()
+            try:
+                self.cycle()
+                print(pid, dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+                      'cycle done in %dms' % int((time.monotonic() - started) * 1000), flush = True)
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+            now = time.monotonic()
+            if next_tick <= now:
+                next_tick += self._interval
+                if next_tick <= now:
+                    self._wake.set()
+                    next_tick += (now - next_tick) // self._interval * self._interval + self._interval
+
+if __name__ == '__main__':
+    from storage import Storage
+    from data_config import addsfile, accounts, lnames, header, footer
+
+    if len(sys.argv) < 6 or len(sys.argv) % 2 != 0:
+        sys.stderr.write('Usage: %s <days> <interval> <directory> <dbfile> <firewall_router[:iptables|:nftables]|-> '
+                         '[<router> <output>]...\n' % sys.argv[0])
+        sys.exit(1)
+
+    days = int(sys.argv[1])
+    interval = float(sys.argv[2])
+    directory = sys.argv[3]
+    db_file = sys.argv[4]
+    firewall_router, _, firewall_backend = sys.argv[5].partition(':')
+    outputs = dict(zip(sys.argv[6::2], sys.argv[7::2]))
+
+    print(os.getpid(), 'load data from file %s' % repr(db_file), flush = True)
+    storage = Storage(db_file, accounts, directory, True, 'ingest')
+    watch = DayFileWatch(directory, [name for account in accounts for host in account.hosts for name in host.namelist])
+    print(os.getpid(), 'watch day files by %s' % ('inotify' if watch.inotify else 'polling'), flush = True)
+    daemon = UsageDaemon(storage, lnames, accounts, directory, addsfile(directory), days,
+                         None if firewall_router == '-' else firewall_router, outputs, header, footer, interval,
+                         watch = watch, firewall_backend = firewall_backend or 'iptables')
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.wake())
+    daemon.run()
+    storage.commit()
+    print(os.getpid(), 'finish usage daemon', flush = True)
@@ -1,11 +1,9 @@
 #!/usr/bin/env python3.8
 
 import sys, time, os
-import protocols as p
 from storage import Storage
 from reports import AccountsReport, HtmlReport
 from datetime import datetime as dt
-from typing import Dict
 from data_config import accounts, lnames, header, footer
 
 timing = time.monotonic()
@@ -26,18 +24,11 @@ db_file = sys.argv[6]
 pid = os.getpid()
 
 print(pid, t(), router, 'load data from file %s' % repr(db_file), flush = True)
-storage = Storage(db_file, accounts, directory, False)
+storage = Storage(db_file, accounts, directory, False, 'report')
 
 reports = AccountsReport(lnames, accounts, storage)
-print(pid, t(), router, 'calculate account usage', flush = True)
-account_usage: Dict[str, Dict[p.Account, p.Usage]] = {}
-for limit_name in lnames:
-    account_usage[limit_name] = reports.account_usage(start_ts, router, limit_name)
-
-print(pid, t(), router, 'calculate host usage', flush = True)
-host_usage: Dict[str, Dict[p.Host, p.Usage]] = {}
-for limit_name in lnames:
-    host_usage[limit_name] = reports.host_usage(start_ts, router, limit_name)
+print(pid, t(), router, 'calculate account and host usage', flush = True)
+account_usage, host_usage = reports.usage(start_ts, router)
 print(pid, t(), router, 'calculate daily report', flush = True)
 account_usage_daily = reports.account_usage_periodic(start_ts, router, days, period = 'day')
 print(pid, t(), router, 'calculate hourly report', flush = True)
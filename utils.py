@@ -1,5 +1,5 @@
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Union, Optional
 from enum import Enum
 
@@ -51,13 +51,19 @@ def units2bytes(amount: Union[str, int, float], units: Optional[Units] = None) -
         return int(amount * units.value)
     raise RuntimeError('Invalid arguments combination.')
 
+EPOCH = datetime(1970, 1, 1)
+ONE_MINUTE = timedelta(minutes = 1)
+def ts2minute(ts: datetime) -> int:
+    return (ts - EPOCH) // ONE_MINUTE
+
+def minute2ts(minute: int) -> datetime:
+    return EPOCH + timedelta(minutes = minute)
+
 def ts2filter(ts: datetime, sign: str = '>', flt: Optional[str] = None, equal: bool = True) -> str:
     if sign not in ('<', '>'):
         raise RuntimeError('Sign can only be one of < or >, not %s' % repr(sign))
     the_equal = '=' if equal else ''
-    the_filter = '''(year {s} {y} OR (year = {y} AND (month {s} {m} OR (month = {m} AND (day {s} {d} OR (day = {d} AND (hour {s} {H} OR (hour = {H} AND minute {s}{e} {M}))))))))'''\
-        .format(y = ts.year, m = ts.month, d = ts.day, H = ts.hour, M = ts.minute, s = sign, e = the_equal)
+    the_filter = 'ts %s%s %d' % (sign, the_equal, ts2minute(ts))
     if flt is not None:
         the_filter = '%s AND (%s)' % (the_filter, flt)
     return the_filter
-    
@@ -0,0 +1,107 @@
+import os, struct, ctypes, ctypes.util
+from typing import Iterable, List, Dict, Optional, Set
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+HOST_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+def _libc() -> Optional[ctypes.CDLL]:
+    try: libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+    except OSError: return None
+    return libc if hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch') else None
+
+class DayFileWatch(object):
+    """Files changed in the host directories of data_path since the last changed() call, from inotify where
+    available, else by polling the directories against a modification time high-watermark."""
+    def __init__(self, data_path: str, hostnames: Iterable[str], use_inotify: bool = True) -> None:
+        self._data_path = data_path
+        self._hostnames = set(hostnames)
+        self._libc = _libc() if use_inotify else None
+        self._fd: Optional[int] = None
+        self._dirs: Dict[int, str] = {}
+        self._watermarks: Dict[str, float] = {}
+        # nothing is known about the changes before the first call
+        self._full = True
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+                self._watch(data_path, IN_CREATE | IN_MOVED_TO)
+                for hostname in self._hostnames:
+                    self._watch(os.path.join(data_path, hostname), HOST_MASK)
+
+    @property
+    def inotify(self) -> bool:
+        return self._fd is not None
+
+    def fileno(self) -> Optional[int]:
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _watch(self, path: str, mask: int) -> None:
+        assert self._libc is not None and self._fd is not None
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd >= 0: self._dirs[wd] = path
+
+    def _read_events(self) -> Set[str]:
+        assert self._fd is not None
+        changed: Set[str] = set()
+        while True:
+            try: data = os.read(self._fd, 65536)
+            except BlockingIOError: break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, size = EVENT.unpack_from(data, pos)
+                name = os.fsdecode(data[pos + EVENT.size:pos + EVENT.size + size].rstrip(b'\0'))
+                pos += EVENT.size + size
+                if mask & IN_Q_OVERFLOW:
+                    self._full = True
+                elif wd not in self._dirs:
+                    continue
+                elif self._dirs[wd] == self._data_path:
+                    if mask & IN_ISDIR and name in self._hostnames:
+                        # files written before the new watch are only seen by a full scan
+                        self._watch(os.path.join(self._data_path, name), HOST_MASK)
+                        self._full = True
+                elif not mask & IN_ISDIR:
+                    changed.add(os.path.join(self._dirs[wd], name))
+        return changed
+
+    def _poll(self) -> Set[str]:
+        changed: Set[str] = set()
+        for hostname in self._hostnames:
+            path = os.path.join(self._data_path, hostname)
+            try: entries = list(os.scandir(path))
+            except FileNotFoundError: continue
+            watermark = self._watermarks.get(path, 0.0)
+            for entry in entries:
+                try: mtime = entry.stat().st_mtime
+                except FileNotFoundError: continue
+                # a file written again within the same mtime is reported again, loading skips it when unchanged
+                if mtime >= watermark:
+                    changed.add(entry.path)
+                self._watermarks[path] = max(self._watermarks.get(path, 0.0), mtime)
+        return changed
+
+    def rescan(self) -> None:
+        """Make the next changed() call ask for a full scan, e.g. after the paths it returned were not loaded."""
+        self._full = True
+
+    def changed(self) -> Optional[List[str]]:
+        """Paths changed since the last call, None when a full scan is needed instead."""
+        changed = self._read_events() if self._fd is not None else self._poll()
+        if self._full:
+            self._full = False
+            return None
+        return sorted(changed)